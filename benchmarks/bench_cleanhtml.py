@@ -0,0 +1,85 @@
+"""
+Microbenchmark of post body converters: posts/sec of the single-pass html_text converter against both previous
+cleanhtml versions.
+
+Usage: python benchmarks/bench_cleanhtml.py [--corpus PATH] [--repeat N]
+PATH is a thread payload in 4chan API format ({"posts": [...]}) or a directory of them, by default the thread
+captured into benchmarks/corpus (`python benchmarks/replay.py capture`) or, until there is one, the synthetic sample.
+"""
+import argparse
+import html
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from functions import cleanhtml as sync_cleanhtml  # noqa: E402
+from html_text import html_to_text, html_to_text_and_refs  # noqa: E402
+from replay import DEFAULT_CORPUS  # noqa: E402
+
+
+def regex_cleanhtml(raw_html: str) -> str:
+    """
+    cleanhtml of fixed_functions.py before single-pass converter: two regex passes and unescape
+    """
+    clean_a_tags = re.sub(r'<a[^>]*>.*?</a>', '', raw_html, flags=re.DOTALL)
+    return html.unescape(re.sub(r'<[^>]+>', '', clean_a_tags))
+
+
+def load_corpus(path: str) -> list:
+    """
+    :return: "com" fields of all posts in corpus
+    """
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+    bodies = []
+    for file_path in paths:
+        if not file_path.endswith(".json"):
+            continue
+        with open(file_path, "r") as file:
+            payload = json.load(file)
+        bodies.extend(post["com"] for post in payload.get("posts", []) if post.get("com"))
+    return bodies
+
+
+def measure(convert, bodies: list, repeat: int) -> float:
+    """
+    :return: posts per second, best of `repeat` runs
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            convert(body)
+        best = min(best, time.perf_counter() - start)
+    return len(bodies) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cleanhtml microbenchmark")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    bodies = load_corpus(args.corpus)
+    if not bodies:
+        print(f"No posts with text in {args.corpus}")
+        sys.exit(1)
+    print(f"{args.corpus}: {len(bodies)} posts, {sum(map(len, bodies))} characters, best of {args.repeat} runs")
+    converters = [
+        ("functions.cleanhtml (find loop)", sync_cleanhtml),
+        ("fixed_functions.cleanhtml (2x regex)", regex_cleanhtml),
+        ("html_text.html_to_text", html_to_text),
+        ("html_text.html_to_text_and_refs", html_to_text_and_refs),
+    ]
+    baseline = None
+    for name, convert in converters:
+        rate = measure(convert, bodies, args.repeat)
+        baseline = baseline or rate
+        print(f"{name:<40} {rate:>12,.0f} posts/sec {rate / baseline:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
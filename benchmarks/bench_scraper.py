@@ -0,0 +1,225 @@
+"""
+End-to-end throughput benchmark: runs the scraper against the replay server (see replay.py) and reports threads/sec,
+requests/sec and p50/p99 request latency of the catalog and archive phases, and bytes written.
+
+Usage: python benchmarks/bench_scraper.py CASSETTE [--runs 2] [--rate 100] [--legacy] [--latency 0.05]
+       [--error-rate 0.01] [--not-modified-rate 0.1] [--json]
+
+Every scraper starts from an empty directory, later runs of --runs continue in it (incremental checks, 304s).
+--rate is requests_per_second of fixed_functions, 100 by default so the benchmark measures the pipeline and not the
+rate limit. --legacy also runs functions.main, which always waits 1 second between threads. Latency is time until
+response headers for fixed_functions and until the whole response for functions.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+from urllib.parse import urlsplit
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import client  # noqa: E402
+import logger  # noqa: E402
+from boards import API_URL, DEFAULT_BOARD, THREADS_URL  # noqa: E402
+from replay import Cassette, add_server_arguments, server_from_arguments  # noqa: E402
+
+BENCH_RATE = 100.0
+PHASES = ("catalog", "archive")
+# files of a run that aren't scraper output
+NOT_OUTPUT = {"config.json", "logs.log"}
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class RequestLog:
+    """
+    (phase, path, status, start, end) of every request of a run
+    """
+
+    def __init__(self, phases: dict):
+        self.phases = phases
+        self.requests = []
+
+    def add(self, url: str, status: int, start: float, end: float) -> None:
+        path = urlsplit(url).path
+        self.requests.append((self.phases.get(path, "catalog"), path, status, start, end))
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(_, context, params) -> None:
+            context.start = time.perf_counter()
+
+        async def on_request_end(_, context, params) -> None:
+            self.add(str(params.url), params.response.status, context.start, time.perf_counter())
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def report(self) -> dict:
+        result = {}
+        for phase in PHASES:
+            requests = [request for request in self.requests if request[0] == phase]
+            if not requests:
+                continue
+            elapsed = max(end for *_, end in requests) - min(start for *_, start, _ in requests)
+            threads = sum(1 for _, path, status, _, _ in requests if "/thread/" in path and status == 200)
+            latencies = [end - start for *_, start, end in requests]
+            result[phase] = {
+                "requests": len(requests),
+                "threads": threads,
+                "seconds": round(elapsed, 3),
+                "requests_per_second": round(len(requests) / elapsed, 1) if elapsed else 0.0,
+                "threads_per_second": round(threads / elapsed, 1) if elapsed else 0.0,
+                "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+                "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            }
+        return result
+
+
+def output_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory)
+               for name in names if name not in NOT_OUTPUT)
+
+
+def write_config(directory: str, cassette: Cassette, url: str, rate: float) -> None:
+    config = {
+        "last_archive_element": 0,
+        "folder_path": "threads",
+        "catalog_modified_date": "Thu, 01 Jan 1970 00:00:00 GMT",
+        "archive_modified_date": "Thu, 01 Jan 1970 00:00:00 GMT",
+        "api_url": url,
+        "boards_url": url,
+        "requests_per_second": rate,
+        "max_requests_per_second": rate,
+        "burst": max(1, int(rate)),
+    }
+    if cassette.board != DEFAULT_BOARD:
+        config["boards"] = [cassette.board]
+    with open(os.path.join(directory, "config.json"), "w") as file:
+        json.dump(config, file)
+
+
+def run_fixed(log: RequestLog) -> None:
+    import fixed_functions
+    trace_config = log.trace_config()
+    client.TRACE_CONFIGS.append(trace_config)
+    try:
+        asyncio.run(fixed_functions.main())
+    finally:
+        client.TRACE_CONFIGS.remove(trace_config)
+
+
+def run_legacy(log: RequestLog, url: str) -> None:
+    import functions
+    import requests
+
+    def get(link: str, **kwargs):
+        link = link.replace(API_URL, url).replace(THREADS_URL, url)
+        start = time.perf_counter()
+        response = requests.get(link, **kwargs)
+        log.add(link, response.status_code, start, time.perf_counter())
+        return response
+
+    # functions.py has 4chan urls built in, its requests go to the replay server through this module
+    original = functions.requests
+    functions.requests = types.SimpleNamespace(get=get)
+    try:
+        functions.main()
+    finally:
+        functions.requests = original
+
+
+def bench(name: str, cassette: Cassette, args: argparse.Namespace) -> list:
+    """
+    :return: report of every run
+    """
+    server = server_from_arguments(cassette, args)
+    url = server.start()
+    directory = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    write_config(directory, cassette, url, args.rate)
+    reports = []
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        for run in range(args.runs):
+            log = RequestLog(cassette.phases())
+            served_before = server.bytes_sent
+            size_before = output_size(directory)
+            start = time.perf_counter()
+            if name == "fixed_functions":
+                run_fixed(log)
+            else:
+                run_legacy(log, url)
+            elapsed = time.perf_counter() - start
+            reports.append({
+                "scraper": name,
+                "run": run + 1,
+                "seconds": round(elapsed, 3),
+                "requests": len(log.requests),
+                "bytes_received": server.bytes_sent - served_before,
+                "bytes_written": output_size(directory) - size_before,
+                "phases": log.report(),
+            })
+    finally:
+        os.chdir(cwd)
+        server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    return reports
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['scraper']} run {report['run']}: {report['seconds']:.1f} s, {report['requests']} requests, "
+          f"{report['bytes_received']} bytes received, {report['bytes_written']} bytes written")
+    for phase, values in report["phases"].items():
+        print(f"    {phase:<8} {values['threads']:>6} threads {values['threads_per_second']:>8.1f} threads/s "
+              f"{values['requests_per_second']:>8.1f} req/s   latency p50 {values['latency_p50_ms']:.1f} ms "
+              f"p99 {values['latency_p99_ms']:.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Scraper throughput against replayed API")
+    parser.add_argument("cassette")
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=BENCH_RATE, help="requests_per_second of fixed_functions")
+    parser.add_argument("--legacy", action="store_true", help="also run functions.main (slow, 1 thread/s)")
+    parser.add_argument("--json", action="store_true", help="print reports as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep scraper log output")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    cassette = Cassette.load(os.path.abspath(args.cassette))
+    # runs of the benchmark don't belong in logs.log of the scraper
+    logger.logger.removeHandler(logger.file_handler)
+    if not args.verbose:
+        logger.console_handler.setLevel(logging.WARNING)
+    reports = bench("fixed_functions", cassette, args)
+    if args.legacy:
+        if cassette.board != DEFAULT_BOARD:
+            print(f"functions.main scrapes /{DEFAULT_BOARD}/ only, skipped", file=sys.stderr)
+        else:
+            reports += bench("functions", cassette, args)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
+
+
+if __name__ == "__main__":
+    main()
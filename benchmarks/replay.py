@@ -0,0 +1,345 @@
+"""
+Offline record/replay of 4chan API responses for end-to-end benchmarks.
+
+A cassette is a gzip-compressed NDJSON file: the first line describes the board and which threads were listed in the
+catalog and in the archive, every next line is one recorded response {"path", "status", "headers", "body"}.
+Listings in a cassette are trimmed to the threads it holds, so a replayed run never asks for a thread it doesn't have.
+
+Usage:
+    python benchmarks/replay.py record CASSETTE [--board biz] [--archive-limit 300] [--rate 1]
+    python benchmarks/replay.py synth CASSETTE [--corpus PATH] [--catalog 150] [--archive 300]
+    python benchmarks/replay.py serve CASSETTE [--port 8080] [--latency 0.05] [--error-rate 0.01] [--not-modified-rate 0]
+    python benchmarks/replay.py capture [--board biz] [--no N] [--output benchmarks/corpus/thread.json]
+
+record fetches threads.json, catalog.json, archive.json and the listed threads from the live API (politely, at
+--rate requests per second), synth builds a cassette from a sample thread payload without network, serve replays a
+cassette until interrupted, capture saves one live thread (the one with most replies by default) as the corpus of
+benchmarks.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from boards import API_URL, DEFAULT_BOARD, THREADS_URL  # noqa: E402
+from rate_limiter import RateLimiter  # noqa: E402
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+# thread captured from the live API by `capture`, the synthetic one stands in while there is none
+CAPTURED_CORPUS = os.path.join(CORPUS_DIR, "thread.json")
+SYNTHETIC_CORPUS = os.path.join(CORPUS_DIR, "synthetic_thread.json")
+DEFAULT_CORPUS = CAPTURED_CORPUS if os.path.exists(CAPTURED_CORPUS) else SYNTHETIC_CORPUS
+ARCHIVE_LIMIT = 300
+PAGE_SIZE = 15
+# response headers kept in cassette, the rest is noise for replay
+KEPT_HEADERS = ("Content-Type", "Last-Modified", "ETag")
+ERROR_STATUSES = (429, 503)
+
+
+class Cassette:
+    """
+    Recorded responses of one board by request path
+    """
+
+    def __init__(self, board: str = DEFAULT_BOARD, catalog: list = None, archive: list = None,
+                 responses: dict = None):
+        self.board = board
+        self.catalog = catalog or []
+        self.archive = archive or []
+        self.responses = responses or {}
+
+    @classmethod
+    def load(cls, path: str) -> "Cassette":
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            header = json.loads(file.readline())
+            cassette = cls(header["board"], header["catalog"], header["archive"])
+            for line in file:
+                response = json.loads(line)
+                cassette.responses[response.pop("path")] = response
+        return cassette
+
+    def save(self, path: str) -> None:
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            file.write(json.dumps({"board": self.board, "catalog": self.catalog, "archive": self.archive}) + "\n")
+            for request_path, response in self.responses.items():
+                file.write(json.dumps(dict(response, path=request_path)) + "\n")
+
+    def add(self, path: str, body: str, status: int = 200, headers: dict = None) -> None:
+        self.responses[path] = {"status": status, "headers": headers or {"Content-Type": "application/json"},
+                                "body": body}
+
+    def thread_path(self, no: int) -> str:
+        return f"/{self.board}/thread/{no}.json"
+
+    def phases(self) -> dict:
+        """
+        :return: phase of the scraper ("catalog" or "archive") that requests each recorded path
+        """
+        archived = {self.thread_path(no) for no in self.archive}
+        return {path: "archive" if path in archived or path.endswith("/archive.json") else "catalog"
+                for path in self.responses}
+
+    def trim_listings(self) -> None:
+        """
+        Drops threads that aren't recorded from threads.json, catalog.json and archive.json
+        """
+        recorded = {no for no in self.catalog + self.archive if self.thread_path(no) in self.responses}
+        self.catalog = [no for no in self.catalog if no in recorded]
+        self.archive = [no for no in self.archive if no in recorded]
+        for name in ("threads.json", "catalog.json"):
+            response = self.responses.get(f"/{self.board}/{name}")
+            if response is None:
+                continue
+            pages = json.loads(response["body"])
+            for page in pages:
+                page["threads"] = [thread for thread in page["threads"] if thread["no"] in recorded]
+            response["body"] = json.dumps(pages)
+        response = self.responses.get(f"/{self.board}/archive.json")
+        if response is not None:
+            response["body"] = json.dumps(self.archive)
+
+
+async def record(board: str = DEFAULT_BOARD, archive_limit: int = ARCHIVE_LIMIT, rate: float = 1.0) -> Cassette:
+    """
+    :param archive_limit: how many of the newest archived threads are recorded
+    :param rate: requests per second sent to the live API
+    :return: cassette of listings, every catalog thread and `archive_limit` archived threads
+    """
+    cassette = Cassette(board)
+    rate_limiter = RateLimiter(rate=rate, burst=1, max_rate=rate)
+
+    async def fetch(session: aiohttp.ClientSession, base: str, path: str) -> bool:
+        await rate_limiter.acquire()
+        async with session.get(base + path) as response:
+            body = await response.text()
+            if response.status != 200:
+                print(f"{path}: {response.status}", file=sys.stderr)
+                return False
+            cassette.add(path, body, headers={key: response.headers[key] for key in KEPT_HEADERS
+                                              if key in response.headers})
+            return True
+
+    async with aiohttp.ClientSession() as session:
+        for name in ("threads.json", "catalog.json", "archive.json"):
+            if not await fetch(session, API_URL, f"/{board}/{name}"):
+                raise RuntimeError(f"Unable to record {name}")
+        pages = json.loads(cassette.responses[f"/{board}/threads.json"]["body"])
+        cassette.catalog = [thread["no"] for page in pages for thread in page["threads"]]
+        cassette.archive = json.loads(cassette.responses[f"/{board}/archive.json"]["body"])[-archive_limit:]
+        for i, no in enumerate(cassette.catalog + cassette.archive):
+            await fetch(session, THREADS_URL, cassette.thread_path(no))
+            if (i + 1) % 50 == 0:
+                print(f"{i + 1} threads recorded", file=sys.stderr)
+    cassette.trim_listings()
+    return cassette
+
+
+async def capture(board: str = DEFAULT_BOARD, no: int = None) -> str:
+    """
+    :param no: thread to capture, by default the catalog thread with most replies
+    :return: thread payload as served by the live API
+    """
+    async with aiohttp.ClientSession(raise_for_status=True) as session:
+        if no is None:
+            async with session.get(f"{API_URL}/{board}/threads.json") as response:
+                pages = await response.json()
+            no = max((thread for page in pages for thread in page["threads"]),
+                     key=lambda thread: thread.get("replies", 0))["no"]
+        async with session.get(f"{THREADS_URL}/{board}/thread/{no}.json") as response:
+            return await response.text()
+
+
+def synthesize(corpus: str = DEFAULT_CORPUS, board: str = DEFAULT_BOARD, catalog: int = 150,
+               archive: int = ARCHIVE_LIMIT) -> Cassette:
+    """
+    Builds cassette without network: every thread is a renumbered copy of the sample thread payload
+    :param corpus: thread payload in 4chan API format ({"posts": [...]})
+    :param catalog: amount of catalog threads
+    :param archive: amount of archived threads
+    """
+    with open(corpus, "r") as file:
+        sample = json.load(file)["posts"]
+    now = int(time.time())
+    headers = {"Content-Type": "application/json", "Last-Modified": formatdate(now, usegmt=True)}
+    cassette = Cassette(board, [90000000 + i * 1000 for i in range(catalog)],
+                        [80000000 + i * 1000 for i in range(archive)])
+    archived = set(cassette.archive)
+    listing = []
+    for no in cassette.catalog + cassette.archive:
+        posts = [dict(post, no=no + i, resto=0 if i == 0 else no) for i, post in enumerate(sample)]
+        posts[0]["replies"] = len(posts) - 1
+        if no in archived:
+            posts[0]["archived"] = 1
+        else:
+            listing.append({"no": no, "last_modified": now, "replies": len(posts) - 1})
+        cassette.add(cassette.thread_path(no), json.dumps({"posts": posts}), headers=headers)
+    pages = [{"page": i // PAGE_SIZE + 1, "threads": listing[i:i + PAGE_SIZE]}
+             for i in range(0, len(listing), PAGE_SIZE)]
+    cassette.add(f"/{board}/threads.json", json.dumps(pages), headers=headers)
+    cassette.add(f"/{board}/catalog.json", json.dumps(pages), headers=headers)
+    cassette.add(f"/{board}/archive.json", json.dumps(cassette.archive), headers=headers)
+    return cassette
+
+
+class ReplayServer:
+    """
+    Local stand-in of the API that answers from a cassette. Every response is delayed by `latency` seconds
+    (+- `jitter`), `error_rate` of requests get 429/503, conditional requests get 304 when their validators match the
+    recorded ones and `not_modified_rate` of the other conditional requests get 304 anyway. Paths missing from the
+    cassette get 404. Random decisions are seeded, so runs with the same settings get the same answers.
+    """
+
+    def __init__(self, cassette: Cassette, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 not_modified_rate: float = 0.0, seed: int = 0):
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.not_modified_rate = not_modified_rate
+        self.random = random.Random(seed)
+        self.url = None
+        self.requests = 0
+        self.bytes_sent = 0
+        self.loop = None
+        self.thread = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.Response(status=self.random.choice(ERROR_STATUSES), headers={"Retry-After": "0"})
+        recorded = self.cassette.responses.get(request.path)
+        if recorded is None:
+            return web.Response(status=404, text="404 Not Found", content_type="text/html")
+        headers = dict(recorded["headers"])
+        if self._not_modified(request, headers):
+            return web.Response(status=304, headers={key: value for key, value in headers.items()
+                                                     if key != "Content-Type"})
+        body = recorded["body"].encode()
+        self.bytes_sent += len(body)
+        content_type = headers.pop("Content-Type", "application/json").split(";")[0]
+        return web.Response(status=recorded["status"], body=body, headers=headers, content_type=content_type)
+
+    def _not_modified(self, request: web.Request, headers: dict) -> bool:
+        if_none_match = request.headers.get("If-None-Match")
+        if_modified_since = request.headers.get("If-Modified-Since")
+        if not if_none_match and not if_modified_since:
+            return False
+        if if_none_match and if_none_match == headers.get("ETag"):
+            return True
+        if if_modified_since and headers.get("Last-Modified"):
+            try:
+                if parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(headers["Last-Modified"]):
+                    return True
+            except (TypeError, ValueError) as _:
+                pass
+        return bool(self.not_modified_rate) and self.random.random() < self.not_modified_rate
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Starts serving in a background thread, so blocking scrapers can be driven from the main thread
+        :return: base url of the server
+        """
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        def serve() -> None:
+            asyncio.set_event_loop(self.loop)
+            runner = web.AppRunner(self.app(), access_log=None)
+            self.loop.run_until_complete(runner.setup())
+            self.loop.run_until_complete(web.TCPSite(runner, host, port).start())
+            self.url = f"http://{host}:{runner.addresses[0][1]}"
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(runner.cleanup())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.url
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every response is delayed")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +- seconds added to latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429/503")
+    parser.add_argument("--not-modified-rate", type=float, default=0.0,
+                        help="share of conditional requests answered with 304 even if validators don't match")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def server_from_arguments(cassette: Cassette, args: argparse.Namespace) -> ReplayServer:
+    return ReplayServer(cassette, args.latency, args.jitter, args.error_rate, args.not_modified_rate, args.seed)
+
+
+if __name__ == "__main__":
+    main_parser = argparse.ArgumentParser(description="Record and replay 4chan API responses")
+    commands = main_parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="record cassette from the live API")
+    record_parser.add_argument("cassette")
+    record_parser.add_argument("--board", default=DEFAULT_BOARD)
+    record_parser.add_argument("--archive-limit", type=int, default=ARCHIVE_LIMIT)
+    record_parser.add_argument("--rate", type=float, default=1.0)
+    synth_parser = commands.add_parser("synth", help="build cassette from a sample thread")
+    synth_parser.add_argument("cassette")
+    synth_parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    synth_parser.add_argument("--board", default=DEFAULT_BOARD)
+    synth_parser.add_argument("--catalog", type=int, default=150)
+    synth_parser.add_argument("--archive", type=int, default=ARCHIVE_LIMIT)
+    capture_parser = commands.add_parser("capture", help="save a live thread as the corpus of benchmarks")
+    capture_parser.add_argument("--board", default=DEFAULT_BOARD)
+    capture_parser.add_argument("--no", type=int, help="thread to capture, the one with most replies by default")
+    capture_parser.add_argument("--output", default=CAPTURED_CORPUS)
+    serve_parser = commands.add_parser("serve", help="replay cassette")
+    serve_parser.add_argument("cassette")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    add_server_arguments(serve_parser)
+    args = main_parser.parse_args()
+
+    if args.command == "record":
+        recorded_cassette = asyncio.run(record(args.board, args.archive_limit, args.rate))
+    elif args.command == "synth":
+        recorded_cassette = synthesize(args.corpus, args.board, args.catalog, args.archive)
+    elif args.command == "capture":
+        payload = asyncio.run(capture(args.board, args.no))
+        with open(args.output, "w") as output:
+            output.write(payload)
+        print(f"{args.output}: {len(json.loads(payload)['posts'])} posts, {len(payload)} bytes")
+        sys.exit(0)
+    else:
+        server = server_from_arguments(Cassette.load(args.cassette), args)
+        print(f"Replaying {args.cassette} at {server.start(args.host, args.port)}, api_url and boards_url of "
+              f"config.json can point here")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt as _:
+            server.stop()
+        sys.exit(0)
+    recorded_cassette.save(args.cassette)
+    print(f"{args.cassette}: {len(recorded_cassette.catalog)} catalog and {len(recorded_cassette.archive)} archived "
+          f"threads, {os.path.getsize(args.cassette)} bytes")
@@ -0,0 +1,135 @@
+import os
+
+from checkpoint import STATE_KEYS
+from compressed_storage import COMPRESSED_PATH
+from manifest import MANIFEST_PATH
+from media import MEDIA_QUEUE_PATH
+from segment_storage import SEGMENTS_PATH
+from sharding import HashRing
+from sqlite_storage import STORAGE_PATH
+from validators import VALIDATORS_PATH
+
+DEFAULT_BOARD = "biz"
+API_URL = "https://a.4cdn.org"
+THREADS_URL = "https://boards.4channel.org"
+IMAGES_URL = "https://i.4cdn.org"
+
+
+class Board:
+    """
+    One shard of a board. A board listed with several shards in `board_shards` has its threads split between shards
+    by consistent hashing of thread no, every shard keeps its own storage, manifest, checkpoint and validators, so
+    shards of one board can run in different processes without fetching the same thread twice.
+    """
+
+    def __init__(self, name: str = DEFAULT_BOARD, shard: int = 0, shards: int = 1, api_url: str = API_URL,
+                 boards_url: str = THREADS_URL):
+        """
+        :param api_url: base url of threads.json, catalog.json and archive.json
+        :param boards_url: base url of thread endpoints
+        """
+        self.name = name
+        self.shard = shard
+        self.shards = shards
+        self.api_url = api_url
+        self.boards_url = boards_url
+        self.ring = HashRing(list(range(shards))) if shards > 1 else None
+
+    @property
+    def key(self) -> str:
+        """
+        :return: name of board shard, used to assign it to a worker
+        """
+        return self.name if self.shards == 1 else f"{self.name}#{self.shard}"
+
+    @property
+    def directory(self) -> str:
+        return self.name if self.shards == 1 else os.path.join(self.name, str(self.shard))
+
+    @property
+    def threads_url(self) -> str:
+        return f"{self.api_url}/{self.name}/threads.json"
+
+    @property
+    def catalog_url(self) -> str:
+        return f"{self.api_url}/{self.name}/catalog.json"
+
+    @property
+    def archive_url(self) -> str:
+        return f"{self.api_url}/{self.name}/archive.json"
+
+    def thread_url(self, no: int) -> str:
+        return f"{self.boards_url}/{self.name}/thread/{no}.json"
+
+    def owns(self, no: int) -> bool:
+        """
+        :return: True if thread belongs to this shard of the board
+        """
+        return self.ring is None or self.ring.node_for(str(no)) == self.shard
+
+    def config(self, config: dict) -> dict:
+        """
+        :param config: config.json content
+        :return: config of board shard. Without `boards` in config paths of an unsharded board are used as is (single
+            /biz/ board, layout of previous versions), otherwise every path is placed into {board}/ (or {board}/{shard}/)
+            directory and checkpoint starts from defaults. Shards always get their own directories, they must not
+            share manifest, durable archive queue, validators or change feed
+        """
+        result = dict(config, board=self.name)
+        if "boards" not in config and self.shards == 1:
+            return result
+        paths = {
+            "folder_path": config["folder_path"],
+            "manifest_path": config.get("manifest_path", MANIFEST_PATH),
+            "validators_path": config.get("validators_path", VALIDATORS_PATH),
+        }
+        backend = config.get("storage_backend")
+        default_paths = {"sqlite": STORAGE_PATH, "segments": SEGMENTS_PATH, "compressed": COMPRESSED_PATH}
+        if backend in default_paths:
+            paths["storage_path"] = config.get("storage_path", default_paths[backend])
+        if config.get("feed_path"):
+            paths["feed_path"] = config["feed_path"]
+        if config.get("index_path"):
+            paths["index_path"] = config["index_path"]
+        if config.get("download_media"):
+            # files are shared by all boards in `media_path`, every shard queues its own posts
+            paths["media_queue_path"] = config.get("media_queue_path", MEDIA_QUEUE_PATH)
+        for key, path in paths.items():
+            result[key] = os.path.join(self.directory, path)
+        for key in STATE_KEYS:
+            result.pop(key, None)
+        return result
+
+
+def all_boards(config: dict) -> list:
+    """
+    :return: every shard of every board from `boards` (and `board_shards`) in config, `api_url` and `boards_url`
+        replace 4chan hosts (e.g. with replay server of benchmarks)
+    """
+    shards = config.get("board_shards", {})
+    return [Board(name, shard, shards.get(name, 1), config.get("api_url", API_URL),
+                  config.get("boards_url", THREADS_URL))
+            for name in config.get("boards", [DEFAULT_BOARD]) for shard in range(shards.get(name, 1))]
+
+
+def assigned_boards(config: dict, worker: int = 0, workers: int = 1) -> list:
+    """
+    :param worker: index of worker, workers of all hosts are numbered together
+    :param workers: total amount of workers
+    :return: board shards that belong to worker
+    """
+    boards = all_boards(config)
+    if workers == 1:
+        return boards
+    ring = HashRing(list(range(workers)))
+    return [board for board in boards if ring.node_for(board.key) == worker]
+
+
+def make_directories(config: dict) -> None:
+    """
+    Creates folders of board shard paths
+    """
+    os.makedirs(config["folder_path"], exist_ok=True)
+    for key in ("manifest_path", "validators_path", "storage_path", "feed_path", "index_path", "media_queue_path"):
+        if config.get(key) and os.path.dirname(config[key]):
+            os.makedirs(os.path.dirname(config[key]), exist_ok=True)
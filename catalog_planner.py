@@ -0,0 +1,84 @@
+from boards import Board
+from manifest import Manifest
+from metrics import metrics
+
+
+class CatalogPlan:
+    """
+    Fetch plan of one catalog check: threads to create, threads to update and threads whose last_modified isn't
+    known from threads.json (until catalog.json is merged in they're planned as new or changed)
+    """
+
+    def __init__(self, new: list, changed: list, unknown: list, listed: int, catalog_fetched: bool = False):
+        """
+        :param listed: amount of threads of the shard listed in threads.json
+        :param catalog_fetched: catalog.json was requested to complete the plan
+        """
+        self.new = new
+        self.changed = changed
+        self.unknown = unknown
+        self.listed = listed
+        self.catalog_fetched = catalog_fetched
+
+    @property
+    def needs_catalog(self) -> bool:
+        return bool(self.unknown)
+
+    @property
+    def unchanged(self) -> int:
+        return self.listed - len(self.new) - len(self.changed)
+
+
+class CatalogPlanner:
+    """
+    Builds fetch plan of catalog check from threads.json alone.
+    threads.json lists `no`, `last_modified` and `replies` of every thread on the board, together with the manifest
+    that is enough to tell new, changed and unchanged threads, so catalog.json (the same threads with OP and last
+    replies, many times bigger) isn't requested. It's requested only when some listed thread has no `last_modified`
+    (e.g. a mirror given as `api_url` serves reduced threads.json), then its `last_modified` values are merged in and
+    the plan is built again.
+    Requests and bytes saved by every plan are counted in `catalog_requests_saved_total` and
+    `catalog_bytes_saved_total`, bytes are the size of catalog.json when it was last downloaded.
+    """
+
+    def __init__(self, manifest: Manifest, board: Board):
+        self.manifest = manifest
+        self.board = board
+
+    def plan(self, threads_mod_date: dict, catalog_last_mod: int, catalog_fetched: bool = False) -> CatalogPlan:
+        """
+        :param threads_mod_date: last_modified of every thread listed in threads.json, None if it isn't known
+        :param catalog_last_mod: timestamp of previous catalog check, used for threads stored without last_modified
+        :param catalog_fetched: last_modified values of catalog.json were already merged into threads_mod_date,
+            stored threads still without last_modified are treated as changed
+        :return: plan, threads of other shards of the board are skipped
+        """
+        new, changed, unknown = [], [], []
+        listed = 0
+        for no, last_modified in threads_mod_date.items():
+            if not self.board.owns(no):
+                continue
+            listed += 1
+            entry = self.manifest.get(no)
+            if entry is not None and entry["sealed"]:
+                continue
+            if last_modified is None:
+                unknown.append(no)
+            if entry is None:
+                new.append(no)
+            # Тут была проблема, что если тред не был изменен, скрапер все равно делал запрос, чтобы убедиться в этом
+            elif last_modified is None or last_modified > (entry["last_modified"] or catalog_last_mod):
+                changed.append(no)
+        return CatalogPlan(new, changed, [] if catalog_fetched else unknown, listed, catalog_fetched)
+
+    def report(self, plan: CatalogPlan, catalog_bytes: int = None) -> tuple:
+        """
+        Counts what the plan saved compared to requesting catalog.json and every listed thread
+        :param catalog_bytes: size of catalog.json when it was last downloaded, None if it never was
+        :return: requests and bytes saved
+        """
+        requests = plan.unchanged + (0 if plan.catalog_fetched else 1)
+        saved_bytes = 0 if plan.catalog_fetched or catalog_bytes is None else catalog_bytes
+        metrics.inc("catalog_requests_saved_total", requests, board=self.board.key)
+        metrics.inc("catalog_bytes_saved_total", saved_bytes, board=self.board.key)
+        return requests, saved_bytes
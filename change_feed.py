@@ -0,0 +1,248 @@
+import argparse
+import json
+import os
+import time
+
+from logger import log_error
+from storage import StorageWrapper, ThreadStorage
+from streaming_json import dumps, loads
+
+FEED_SEGMENT_SIZE = 64 * 1024 * 1024
+POLL_INTERVAL = 1.0
+
+
+def segments(directory: str) -> list:
+    """
+    :return: first offsets of feed segments in ascending order, segment file is named by its first offset
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name[:-len(".ndjson")]) for name in os.listdir(directory)
+                  if name.endswith(".ndjson") and name[:-len(".ndjson")].isdigit())
+
+
+def segment_path(directory: str, first_offset: int) -> str:
+    return os.path.join(directory, f"{first_offset:020d}.ndjson")
+
+
+class ChangeFeed:
+    """
+    Ordered durable feed of saved posts for downstream consumers.
+    Every new thread and every new reply is one JSON line {"offset", "type", "thread", "time", "data"}, "type" is
+    "thread" (data is thread without replies) or "reply" (data is reply). Offsets grow by one per record and are never
+    reused. Records go to the current segment file, a new segment is started once it grows over `segment_size`.
+    flush() writes buffered records to disk, it is called by manifest flush, so a thread is recorded as saved only
+    after its records are in the feed.
+    """
+
+    def __init__(self, directory: str, segment_size: int = FEED_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        existing = segments(directory)
+        first_offset = existing[-1] if existing else 0
+        self.next_offset = self._recover(first_offset) if existing else 0
+        self.file = open(segment_path(directory, first_offset), "ab")
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ChangeFeed":
+        return cls(config["feed_path"], config.get("feed_segment_size", FEED_SEGMENT_SIZE))
+
+    def publish_thread(self, no: int, context: dict) -> None:
+        self._publish("thread", no, {key: value for key, value in context.items() if key != "replies"})
+        for reply in context.get("replies", []):
+            self._publish("reply", no, reply)
+
+    def publish_replies(self, no: int, replies: list) -> None:
+        for reply in replies:
+            self._publish("reply", no, reply)
+
+    def flush(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+    def _publish(self, kind: str, no: int, data: dict) -> None:
+        if self.file.tell() >= self.segment_size:
+            self.flush()
+            self.file.close()
+            self.file = open(segment_path(self.directory, self.next_offset), "ab")
+        record = {"offset": self.next_offset, "type": kind, "thread": no, "time": int(time.time()), "data": data}
+        self.file.write(dumps(record).encode() + b"\n")
+        self.next_offset += 1
+
+    def _recover(self, first_offset: int) -> int:
+        """
+        Drops record cut by crash at the end of the last segment
+        :return: offset of the next record
+        """
+        path = segment_path(self.directory, first_offset)
+        next_offset = first_offset
+        end = 0
+        with open(path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                next_offset = loads(line)["offset"] + 1
+                end += len(line)
+        if end < os.path.getsize(path):
+            log_error(f"Dropping broken record at the end of {path}")
+            with open(path, "r+b") as file:
+                file.truncate(end)
+        return next_offset
+
+
+class FeedStorage(StorageWrapper):
+    """
+    Storage that publishes every saved thread and appended reply to change feed, storage is written first
+    """
+
+    def __init__(self, storage: ThreadStorage, feed: ChangeFeed):
+        super().__init__(storage)
+        self.feed = feed
+
+    async def create(self, no: int, context: dict) -> None:
+        await super().create(no, context)
+        self.feed.publish_thread(no, context)
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        # replies the storage already had aren't published again
+        written = await super().append(no, replies, compact)
+        self.feed.publish_replies(no, written)
+        return written
+
+    def flush(self) -> None:
+        super().flush()
+        self.feed.flush()
+
+    def close(self) -> None:
+        super().close()
+        self.feed.close()
+
+
+class FeedReader:
+    """
+    Reads change feed from an offset. Consumer processes records and commits the offset of the next record it needs,
+    committed offset is kept in {directory}/{consumer}.offset, so a restarted consumer continues where it stopped and
+    reads only records that were added since.
+    """
+
+    def __init__(self, directory: str, consumer: str = None, offset: int = None):
+        """
+        :param consumer: name of consumer, its committed offset is used if `offset` isn't given
+        :param offset: first offset to read
+        """
+        self.directory = directory
+        self.consumer = consumer
+        self.offset = offset if offset is not None else self.committed()
+        self.file = None
+        self.segment = None
+
+    def committed(self) -> int:
+        if self.consumer is None:
+            return 0
+        try:
+            with open(self._offset_path(), "r") as file:
+                return int(file.read())
+        except FileNotFoundError as _:
+            return 0
+
+    def commit(self, offset: int = None) -> None:
+        """
+        :param offset: offset of the next record consumer needs, by default the one after the last read record
+        """
+        tmp_path = self._offset_path() + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(str(self.offset if offset is None else offset))
+        os.replace(tmp_path, self._offset_path())
+
+    def read(self, limit: int = None) -> list:
+        """
+        :param limit: maximum amount of records
+        :return: records that are in the feed now, starting from current offset
+        """
+        records = []
+        while limit is None or len(records) < limit:
+            record = self._next()
+            if record is None:
+                break
+            records.append(record)
+        return records
+
+    def tail(self, poll_interval: float = POLL_INTERVAL):
+        """
+        Endless generator of records, waits for new ones when the end of the feed is reached
+        """
+        while True:
+            record = self._next()
+            if record is None:
+                time.sleep(poll_interval)
+                continue
+            yield record
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _offset_path(self) -> str:
+        return os.path.join(self.directory, f"{self.consumer}.offset")
+
+    def _open(self) -> bool:
+        """
+        Opens segment that holds current offset
+        """
+        candidates = [first for first in segments(self.directory) if first <= self.offset]
+        if not candidates:
+            return False
+        self.close()
+        self.segment = candidates[-1]
+        self.file = open(segment_path(self.directory, self.segment), "rb")
+        return True
+
+    def _next(self):
+        """
+        :return: record at current offset or None if it isn't written yet
+        """
+        if self.file is None and not self._open():
+            return None
+        while True:
+            position = self.file.tell()
+            line = self.file.readline()
+            if not line.endswith(b"\n"):
+                # end of segment or record that is being written
+                self.file.seek(position)
+                later = [first for first in segments(self.directory) if self.segment < first <= self.offset]
+                if not later or not self._open():
+                    return None
+                continue
+            record = loads(line)
+            if record["offset"] < self.offset:
+                continue
+            self.offset = record["offset"] + 1
+            return record
+
+
+if __name__ == "__main__":
+    # python change_feed.py <feed_path> [--consumer NAME] [--offset N] [--follow]
+    parser = argparse.ArgumentParser(description="Print change feed records")
+    parser.add_argument("feed_path")
+    parser.add_argument("--consumer", help="read from committed offset of consumer and commit after printing")
+    parser.add_argument("--offset", type=int)
+    parser.add_argument("--follow", action="store_true", help="wait for new records")
+    args = parser.parse_args()
+    reader = FeedReader(args.feed_path, args.consumer, args.offset)
+    try:
+        for feed_record in (reader.tail() if args.follow else reader.read()):
+            print(json.dumps(feed_record, ensure_ascii=False))
+            if args.consumer and args.follow:
+                reader.commit()
+        if args.consumer:
+            reader.commit()
+    except KeyboardInterrupt as _:
+        pass
+    finally:
+        reader.close()
@@ -0,0 +1,88 @@
+from manifest import Manifest
+
+FLUSH_EVERY = 100
+# bookkeeping values that used to be rewritten in config.json, config.json is only read to seed them once
+STATE_KEYS = {
+    "last_archive_element": 0,
+    "catalog_modified_date": "",
+    "archive_modified_date": ""
+}
+
+
+class Checkpoint:
+    """
+    Durable progress of the scraper, kept in the manifest database.
+    `state` table holds bookkeeping values (modification dates, last archive element), `archive_queue` holds ids of
+    the current archive pass with per-id completion flag. Completions are flushed in batches together with manifest
+    changes, so after a crash the pass resumes with the ids that weren't finished.
+    """
+
+    def __init__(self, manifest: Manifest, flush_every: int = FLUSH_EVERY):
+        self.manifest = manifest
+        self.connection = manifest.connection
+        self.flush_every = flush_every
+        self.completed = []
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS archive_queue (no INTEGER PRIMARY KEY, done INTEGER NOT NULL DEFAULT 0)"
+            )
+
+    @classmethod
+    def open(cls, manifest: Manifest, config: dict) -> "Checkpoint":
+        """
+        :param manifest: manifest whose database keeps the checkpoint
+        :param config: used to seed state on the first run
+        :return: checkpoint
+        """
+        checkpoint = cls(manifest)
+        for key, default in STATE_KEYS.items():
+            if checkpoint.get(key) is None:
+                checkpoint.set(key, config.get(key, default))
+        return checkpoint
+
+    def get(self, key: str):
+        row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value = row[0]
+        return int(value) if value.isdigit() else value
+
+    def set(self, key: str, value) -> None:
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def enqueue(self, ids: list) -> None:
+        """
+        Adds ids to the archive pass, ids left from an interrupted pass keep their completion flag
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO archive_queue (no) VALUES (?)", ((no,) for no in ids))
+
+    def pending(self) -> list:
+        """
+        :return: ids of the archive pass that aren't completed yet, in ascending order
+        """
+        return [no for no, in self.connection.execute("SELECT no FROM archive_queue WHERE done = 0 ORDER BY no")]
+
+    def complete(self, no: int) -> None:
+        self.completed.append(no)
+        if len(self.completed) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes manifest changes first, so an id is never recorded as completed before its thread state
+        """
+        self.manifest.flush()
+        if not self.completed:
+            return
+        with self.connection:
+            self.connection.executemany("UPDATE archive_queue SET done = 1 WHERE no = ?",
+                                        ((no,) for no in self.completed))
+        self.completed.clear()
+
+    def finish_pass(self) -> None:
+        self.flush()
+        with self.connection:
+            self.connection.execute("DELETE FROM archive_queue")
@@ -0,0 +1,186 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import aiohttp
+from aiohttp import ContentTypeError
+
+from logger import log_error
+from metrics import metrics
+from rate_limiter import RateLimiter, THROTTLE_STATUSES, parse_retry_after
+from streaming_json import ArrayDecoder, CHUNK_SIZE, loads
+from validators import ValidatorStore, VALIDATORS_PATH
+
+POOL_SIZE = 32
+MAX_IN_FLIGHT = 8
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+MAX_RETRIES = 5
+# aiohttp.TraceConfig instances attached to sessions of every client, benchmarks use them to time requests
+TRACE_CONFIGS = []
+
+
+def endpoint_of(link: str) -> str:
+    """
+    :return: metrics label of url: "thread" for thread endpoints, otherwise name of the JSON file
+    """
+    if "/thread/" in link:
+        return "thread"
+    return link.rsplit("/", 1)[-1].split(".")[0]
+
+
+class _NotModified:
+    """
+    Result of conditional request answered with 304. It is falsy, so callers that only check `if not reply` treat it
+    as nothing to do, callers that care compare with `is NOT_MODIFIED`
+    """
+
+    def __bool__(self) -> bool:
+        return False
+
+    def __repr__(self) -> str:
+        return "NOT_MODIFIED"
+
+
+NOT_MODIFIED = _NotModified()
+
+
+class Client:
+    """
+    One long-lived HTTP client per run.
+    Connections are pooled and kept alive between requests, DNS lookups are cached, and a single semaphore caps
+    the number of requests in flight across the catalog and archive phases. Every request passes the rate limiter.
+    """
+
+    def __init__(self, pool_size: int = POOL_SIZE, max_in_flight: int = MAX_IN_FLIGHT,
+                 dns_cache_ttl: int = DNS_CACHE_TTL, keepalive_timeout: int = KEEPALIVE_TIMEOUT,
+                 rate_limiter: RateLimiter = None, max_retries: int = MAX_RETRIES,
+                 validators: ValidatorStore = None):
+        self.pool_size = pool_size
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.validators = validators or ValidatorStore()
+        # size of the last complete response of stream_json by url
+        self.received = {}
+        self.session = None
+
+    @classmethod
+    def from_config(cls, config: dict, rate_limiter: RateLimiter = None) -> "Client":
+        """
+        :param rate_limiter: limiter shared with other clients of the process, by default client gets its own
+        """
+        return cls(
+            pool_size=config.get("pool_size", POOL_SIZE),
+            max_in_flight=config.get("max_in_flight", MAX_IN_FLIGHT),
+            dns_cache_ttl=config.get("dns_cache_ttl", DNS_CACHE_TTL),
+            keepalive_timeout=config.get("keepalive_timeout", KEEPALIVE_TIMEOUT),
+            rate_limiter=rate_limiter or RateLimiter.from_config(config),
+            max_retries=config.get("max_retries", MAX_RETRIES),
+            validators=ValidatorStore.load(config.get("validators_path", VALIDATORS_PATH)),
+        )
+
+    async def __aenter__(self) -> "Client":
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_size,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=list(TRACE_CONFIGS) or None)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.session.close()
+        self.session = None
+        self.validators.save()
+
+    async def get_json(self, link: str, conditional: bool = False, fallback_date: str = ""):
+        """
+        :param link: url of JSON endpoint
+        :param conditional: send stored Last-Modified / ETag validators, caller must commit them after the response
+            was processed (client.validators.commit(link))
+        :param fallback_date: If-Modified-Since value used when no validator is stored for the url
+        :return: decoded JSON, NOT_MODIFIED on 304 or None if response can't be parsed or server keeps throttling
+        """
+        async with self._request(link, conditional, fallback_date) as response:
+            if response is None or response is NOT_MODIFIED:
+                return response
+            try:
+                return await response.json(loads=loads)
+            except (ContentTypeError, ValueError) as _:
+                log_error(f"Unable to parse JSON from {link}")
+                metrics.inc("request_errors_total", endpoint=endpoint_of(link), reason="parse")
+                return None
+
+    async def stream_json(self, link: str, on_item, conditional: bool = False, fallback_date: str = ""):
+        """
+        Decodes JSON array while it is downloaded, on_item is called with every element as soon as it is complete
+        :param link: url of JSON endpoint that returns array
+        :param on_item: callable that takes one element
+        :param conditional: same as in get_json
+        :param fallback_date: same as in get_json
+        :return: True if whole array was received, NOT_MODIFIED on 304 or None if response can't be parsed, breaks
+            off or server keeps throttling (elements received before that were already passed to on_item)
+        """
+        endpoint = endpoint_of(link)
+        async with self._request(link, conditional, fallback_date) as response:
+            if response is None or response is NOT_MODIFIED:
+                return response
+            if response.content_type != "application/json":
+                log_error(f"Unable to parse JSON from {link}")
+                metrics.inc("request_errors_total", endpoint=endpoint, reason="parse")
+                return None
+            decoder = ArrayDecoder()
+            size = 0
+            try:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    for item in decoder.feed(chunk):
+                        on_item(item)
+                decoder.close()
+            except (aiohttp.ClientPayloadError, ValueError) as _:
+                log_error(f"Unable to parse JSON from {link}")
+                metrics.inc("request_errors_total", endpoint=endpoint, reason="parse")
+                return None
+            self.received[link] = size
+            metrics.inc("response_bytes_total", size, endpoint=endpoint)
+            return True
+
+    @asynccontextmanager
+    async def _request(self, link: str, conditional: bool, fallback_date: str):
+        """
+        GET within the limits of the client: a slot of the semaphore, a token of the rate limiter, retries while the
+        server throttles. Validators of a conditional request are remembered when its response arrives
+        :return: response, body not read yet and the slot still held, NOT_MODIFIED on 304 or None if server keeps
+            throttling
+        """
+        headers = self.validators.headers(link, fallback_date) if conditional else {}
+        endpoint = endpoint_of(link)
+        for _ in range(self.max_retries + 1):
+            waited = time.perf_counter()
+            async with self.semaphore:
+                metrics.histogram("semaphore_wait_seconds", time.perf_counter() - waited)
+                with metrics.timer("rate_limit_wait_seconds"):
+                    await self.rate_limiter.acquire()
+                started = time.perf_counter()
+                async with self.session.get(link, headers=headers) as response:
+                    metrics.histogram("request_seconds", time.perf_counter() - started, endpoint=endpoint)
+                    metrics.inc("requests_total", endpoint=endpoint, status=response.status)
+                    if response.status in THROTTLE_STATUSES:
+                        self.rate_limiter.on_throttle(parse_retry_after(response.headers.get("Retry-After")))
+                        continue
+                    self.rate_limiter.on_success()
+                    if response.status == 304:
+                        yield NOT_MODIFIED
+                        return
+                    if conditional:
+                        self.validators.remember(link, response.headers)
+                    yield response
+                    return
+        log_error(f"Gave up on {link} after {self.max_retries} retries")
+        metrics.inc("request_errors_total", endpoint=endpoint, reason="throttled")
+        yield None
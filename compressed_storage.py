@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import json
+import os
+import struct
+from functools import partial
+
+import aiofiles
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from logger import log_error, log_message
+from metrics import metrics
+from storage import FileStorage, ThreadStorage, last_reply_no, migrate, replies_after, unique_replies
+from streaming_json import dumps, loads
+
+COMPRESSED_PATH = "compressed"
+DICTIONARY_NAME = "dictionary.zdict"
+DICTIONARY_SIZE = 112 * 1024
+# records written without dictionary before one is trained from them, 0 turns training on write off
+TRAIN_SAMPLES = 2000
+# training starts early once kept samples are this big, zstd suggests about 100 times the dictionary size
+TRAIN_SAMPLE_BYTES = 100 * DICTIONARY_SIZE
+COMPRESSION_LEVEL = 3
+# thread is folded into two records once it has this many
+COMPACT_AFTER_RECORDS = 32
+# record header: length of zstd frame
+RECORD = struct.Struct(">I")
+# longest zstd frame header, enough to tell dictionary of frame
+FRAME_HEADER_SIZE = 18
+
+
+def split(thread: dict) -> tuple:
+    """
+    :return: thread without replies and its replies, the first two records of a thread
+    """
+    return {key: value for key, value in thread.items() if key != "replies"}, thread.get("replies", [])
+
+
+class CompressedStorage(ThreadStorage):
+    """
+    One zstd-compressed file per thread, compressed with a dictionary trained on our own threads.
+    {no}.zst is a sequence of records (length of frame, zstd frame of JSON): thread without replies, its replies, and
+    one more record of new replies per append. Stored threads repeat the same keys, image link prefix and date format,
+    with a dictionary of them even a small record compresses well. The dictionary is trained once per directory (from
+    the first `train_samples` records written, at most TRAIN_SAMPLE_BYTES of them, or by `recompress`) and kept in
+    dictionary.zdict. Training on write runs in the default executor, records written meanwhile and before it stay
+    readable and get the dictionary on compaction. read_header() decompresses only the first record.
+    """
+
+    def __init__(self, directory: str, level: int = COMPRESSION_LEVEL, compact_after: int = COMPACT_AFTER_RECORDS,
+                 train_samples: int = TRAIN_SAMPLES):
+        if zstandard is None:
+            raise ImportError("Compressed storage needs zstandard (pip install zstandard)")
+        self.directory = directory
+        self.level = level
+        self.compact_after = compact_after
+        self.train_samples = train_samples
+        os.makedirs(directory, exist_ok=True)
+        # thread no -> no of its last stored reply, threads written before open are read when it's first needed
+        self.last_no = {}
+        self.samples = []
+        self.sample_bytes = 0
+        # dictionary being trained from samples in executor
+        self.training = None
+        self.dictionary = None
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        # by dictionary id of frame, 0 is no dictionary
+        self.decompressors = {0: zstandard.ZstdDecompressor()}
+        if os.path.exists(self.dictionary_path):
+            with open(self.dictionary_path, "rb") as file:
+                self._use(zstandard.ZstdCompressionDict(file.read()))
+
+    @property
+    def dictionary_path(self) -> str:
+        return os.path.join(self.directory, DICTIONARY_NAME)
+
+    def path(self, no: int) -> str:
+        return os.path.join(self.directory, f"{no}.zst")
+
+    def train(self, samples: list, size: int = DICTIONARY_SIZE) -> None:
+        """
+        Trains dictionary of the directory, records written since are compressed with it
+        :param samples: JSON of records (bytes), e.g. stored threads split by split()
+        """
+        if self.dictionary is not None:
+            raise ValueError(f"{self.directory} already has a dictionary")
+        self._save(zstandard.train_dictionary(size, samples, level=self.level), len(samples))
+
+    async def create(self, no: int, context: dict) -> None:
+        """
+        Saves whole thread, previous state of thread is dropped
+        """
+        header, replies = split(context)
+        data = self._record(header) + self._record(replies)
+        tmp_path = self.path(no) + ".tmp"
+        async with aiofiles.open(tmp_path, mode="wb") as file:
+            await file.write(data)
+        os.replace(tmp_path, self.path(no))
+        self.last_no[no] = last_reply_no(replies)
+        metrics.inc("storage_bytes_written_total", len(data), backend="compressed")
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        """
+        :param replies: new replies, appended after already stored ones
+        :param compact: fold records into two right away (e.g. thread won't change anymore)
+        :return: replies that were written
+        """
+        replies = replies_after(replies, self._last_no(no))
+        if replies:
+            data = self._record(replies)
+            async with aiofiles.open(self.path(no), mode="ab") as file:
+                await file.write(data)
+            self.last_no[no] = last_reply_no(replies) or self.last_no[no]
+            metrics.inc("storage_bytes_written_total", len(data), backend="compressed")
+        if compact or len(self._dictionaries(no)) >= self.compact_after:
+            self.compact(no)
+        return replies
+
+    def read(self, no: int) -> dict:
+        records = self._read(no)
+        thread = records[0]
+        thread["replies"] = unique_replies([reply for replies in records[1:] for reply in replies])
+        return thread
+
+    def read_header(self, no: int) -> dict:
+        """
+        :return: thread without replies, only the first record is read and decompressed
+        """
+        return self._read(no, 1)[0]
+
+    def compact(self, no: int) -> None:
+        """
+        Folds records of thread into two, they are compressed again with the current dictionary
+        """
+        header, replies = split(self.read(no))
+        data = self._record(header) + self._record(replies)
+        tmp_path = self.path(no) + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path(no))
+        metrics.inc("storage_bytes_written_total", len(data), backend="compressed")
+
+    def compact_all(self) -> int:
+        """
+        Folds threads with appended records and compresses threads written before the dictionary again
+        :return: amount of compacted threads
+        """
+        dict_id = self.dictionary.dict_id() if self.dictionary is not None else 0
+        compacted = 0
+        for no in self.threads():
+            dictionaries = self._dictionaries(no)
+            if len(dictionaries) > 2 or any(frame_dict_id != dict_id for frame_dict_id in dictionaries):
+                self.compact(no)
+                compacted += 1
+        return compacted
+
+    def threads(self) -> list:
+        return [int(name[:-len(".zst")]) for name in os.listdir(self.directory)
+                if name.endswith(".zst") and name[:-len(".zst")].isdigit()]
+
+    def modified(self, no: int) -> int:
+        return int(os.path.getmtime(self.path(no)))
+
+    def _save(self, dictionary, samples: int) -> None:
+        tmp_path = self.dictionary_path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(dictionary.as_bytes())
+        os.replace(tmp_path, self.dictionary_path)
+        self._use(dictionary)
+        log_message(f"STORAGE | DICTIONARY TRAINED | {samples} samples, {len(dictionary.as_bytes())} bytes")
+
+    def _use(self, dictionary) -> None:
+        self.dictionary = dictionary
+        self.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+        self.decompressors[dictionary.dict_id()] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        self.samples = []
+        self.sample_bytes = 0
+
+    def _record(self, value) -> bytes:
+        data = dumps(value).encode()
+        if self.dictionary is None and self.train_samples and self.training is None:
+            self.samples.append(data)
+            self.sample_bytes += len(data)
+            if len(self.samples) >= self.train_samples or self.sample_bytes >= TRAIN_SAMPLE_BYTES:
+                self._train_samples()
+        frame = self.compressor.compress(data)
+        return RECORD.pack(len(frame)) + frame
+
+    def _train_samples(self) -> None:
+        """
+        Trains dictionary from collected samples, in the default executor if there is a running loop, so writes
+        aren't held up by training
+        """
+        samples, self.samples, self.sample_bytes = self.samples, [], 0
+        train = partial(zstandard.train_dictionary, DICTIONARY_SIZE, samples, level=self.level)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError as _:
+            # e.g. compaction from command line
+            self._trained(train, len(samples))
+            return
+        self.training = loop.run_in_executor(None, train)
+        self.training.add_done_callback(lambda training: self._trained(training.result, len(samples)))
+
+    def _trained(self, result, samples: int) -> None:
+        """
+        :param result: callable that returns trained dictionary
+        """
+        self.training = None
+        try:
+            dictionary = result()
+        except zstandard.ZstdError as e:
+            log_error(f"Unable to train dictionary of {self.directory}: {e}")
+            self.train_samples = 0
+            return
+        if self.dictionary is None:
+            self._save(dictionary, samples)
+
+    def _read(self, no: int, limit: int = None) -> list:
+        """
+        :param limit: amount of first records to read, all by default
+        :return: decoded records, KeyError if thread isn't stored
+        """
+        records = []
+        try:
+            with open(self.path(no), "rb") as file:
+                while limit is None or len(records) < limit:
+                    head = file.read(RECORD.size)
+                    if not head:
+                        break
+                    length = RECORD.unpack(head)[0] if len(head) == RECORD.size else -1
+                    frame = file.read(length) if length > 0 else b""
+                    if len(frame) != length:
+                        # last record could be cut by crash during append
+                        log_error(f"Skipping broken record in {self.path(no)}")
+                        break
+                    records.append(loads(self._decompress(frame)))
+        except FileNotFoundError as _:
+            raise KeyError(no)
+        if not records:
+            raise ValueError(f"Thread {no} has no readable records")
+        return records
+
+    def _decompress(self, frame: bytes) -> bytes:
+        dict_id = zstandard.get_frame_parameters(frame).dict_id
+        decompressor = self.decompressors.get(dict_id)
+        if decompressor is None:
+            raise ValueError(f"Record compressed with unknown dictionary {dict_id}")
+        return decompressor.decompress(frame)
+
+    def _dictionaries(self, no: int) -> list:
+        """
+        :return: dictionary id of every record of thread (0 is no dictionary), only record and frame headers are read
+        """
+        dict_ids = []
+        with open(self.path(no), "rb") as file:
+            while len(head := file.read(RECORD.size)) == RECORD.size:
+                length = RECORD.unpack(head)[0]
+                frame_head = file.read(min(length, FRAME_HEADER_SIZE))
+                try:
+                    dict_ids.append(zstandard.get_frame_parameters(frame_head).dict_id)
+                except zstandard.ZstdError as _:
+                    # record cut by crash, compaction drops it
+                    dict_ids.append(-1)
+                file.seek(length - len(frame_head), os.SEEK_CUR)
+        return dict_ids
+
+    def _last_no(self, no: int) -> int:
+        if no not in self.last_no:
+            self.last_no[no] = last_reply_no(self.read(no)["replies"])
+        return self.last_no[no]
+
+
+def directory_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+               if os.path.isfile(os.path.join(directory, name)))
+
+
+async def recompress(source: ThreadStorage, target: CompressedStorage, samples: int = TRAIN_SAMPLES,
+                     dictionary_size: int = DICTIONARY_SIZE) -> int:
+    """
+    Trains dictionary of target on threads of source (if target doesn't have one) and copies every thread into it
+    :param samples: amount of threads the dictionary is trained on, spread evenly over source
+    :return: amount of copied threads
+    """
+    if target.dictionary is None:
+        threads = sorted(source.threads())
+        step = max(1, len(threads) // samples)
+        records = []
+        for no in threads[::step][:samples]:
+            try:
+                records.extend(dumps(record).encode() for record in split(source.read(no)))
+            except (KeyError, ValueError) as _:
+                continue
+        target.train(records, dictionary_size)
+    return await migrate(source, target)
+
+
+if __name__ == "__main__":
+    # python compressed_storage.py recompress <folder_path> <storage_path> [--level N] [--samples N]
+    # python compressed_storage.py read <storage_path> <no> [--header]
+    parser = argparse.ArgumentParser(description="Dictionary-compressed thread storage")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("recompress", help="copy JSON files of folder_path into compressed storage")
+    command.add_argument("folder_path")
+    command.add_argument("storage_path")
+    command.add_argument("--level", type=int, default=COMPRESSION_LEVEL)
+    command.add_argument("--samples", type=int, default=TRAIN_SAMPLES, help="threads the dictionary is trained on")
+    command.add_argument("--dictionary-size", type=int, default=DICTIONARY_SIZE)
+    command = commands.add_parser("read", help="print stored thread")
+    command.add_argument("storage_path")
+    command.add_argument("no", type=int)
+    command.add_argument("--header", action="store_true", help="thread without replies")
+    args = parser.parse_args()
+
+    if args.command == "recompress":
+        storage = CompressedStorage(args.storage_path, args.level, train_samples=0)
+        try:
+            copied = asyncio.run(recompress(FileStorage(args.folder_path), storage, args.samples,
+                                            args.dictionary_size))
+        finally:
+            storage.close()
+        log_message(f"STORAGE | RECOMPRESSED | {copied} threads, {directory_size(args.folder_path)} bytes -> "
+                    f"{directory_size(args.storage_path)} bytes")
+    else:
+        storage = CompressedStorage(args.storage_path, train_samples=0)
+        print(json.dumps(storage.read_header(args.no) if args.header else storage.read(args.no), ensure_ascii=False))
@@ -1,23 +1,33 @@
 import asyncio
+from bisect import bisect_right
 from datetime import datetime
-import html
+from email.utils import formatdate, parsedate_to_datetime
 import json
-import os
-import re
 import time
 from enum import Enum
-
-import aiofiles
-import aiohttp
-from aiohttp import ContentTypeError
-
+from functools import partial
+
+from boards import Board, DEFAULT_BOARD, IMAGES_URL, assigned_boards, make_directories
+from catalog_planner import CatalogPlan, CatalogPlanner
+from checkpoint import Checkpoint
+from client import Client, NOT_MODIFIED
+from html_text import html_to_text, get_quote_refs
+import logger
 from logger import log_message, log_error
-
-ARCHIVE = 'https://a.4cdn.org/biz/archive.json'
-CATALOG = 'https://a.4cdn.org/biz/catalog.json'
-CATALOG_MODIFIED = 'https://a.4cdn.org/biz/threads.json'
-TASKS_AMOUNT = 4
-lock = asyncio.Lock()
+from manifest import Manifest, MANIFEST_PATH
+from media import MediaDownloader
+from metrics import metrics, start_server, summary_path
+from parse_pool import ParsePool
+from rate_limiter import RateLimiter
+from scheduler import RefreshScheduler
+from storage import ThreadStorage, open_storage
+from work_queue import WorkQueue
+
+POLL_INTERVAL = 30
+ARCHIVE_INTERVAL = 3600
+# archive ids are written to the durable queue in batches of this size while archive.json is downloaded
+ENQUEUE_BATCH = 1000
+FRESHNESS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
 
 
 class Location(Enum):
@@ -25,22 +35,20 @@ class Location(Enum):
     ARCHIVE = "ARCHIVE"
 
 
-# cleanhtml version but without loops, complexity = O(n), n = len(html_s)
+# one compiled markup pass, entities are decoded only if present, complexity = O(n), n = len(html_s)
 def cleanhtml(raw_html: str) -> str:
     """
     :param raw_html: html code
-    :return: text without html code and symbols
+    :return: text without html code and symbols, <br> becomes new line (same structure as on the forum)
     """
-    clean_a_tags = re.sub(r'<a[^>]*>.*?</a>', '', raw_html, flags=re.DOTALL)
-    # clean_a_tags = clean_a_tags.replace('<br>', '\n')  # enable if u want same structure as on the forum
-    return html.unescape(re.sub(r'<[^>]+>', '', clean_a_tags))
+    return html_to_text(raw_html)
 
 
-def get_image_link(source: dict) -> str:
+def get_image_link(source: dict, board: str = DEFAULT_BOARD) -> str:
     ext = source.get("ext")
     i_name = source.get("tim")
     if ext and i_name:
-        return f"https://i.4cdn.org/biz/{i_name}{ext}"
+        return f"{IMAGES_URL}/{board}/{i_name}{ext}"
     return ""
 
 
@@ -58,225 +66,478 @@ def get_text(source: dict) -> str:
     return cleanhtml(source.get("com", ""))
 
 
-async def async_file_writer(file_name: str, lines: str):
-    async with aiofiles.open(file_name, mode='w') as f:
-        await f.write(lines)
+def get_refs(source: dict) -> list:
+    """
+    :return: numbers of posts the post quotes
+    """
+    return get_quote_refs(source.get("com", ""))
 
 
-async def set_catalog_mod_date():
-    async with lock:
-        with open("config.json", "r") as file:
-            config = json.load(file)
-        config["catalog_modified_date"] = datetime.now().strftime('%a, %d %b %Y %H:%M:%S') + " GMT"
-        with open("config.json", "w") as file:
-            json.dump(config, file)
+def get_media(source: dict) -> dict:
+    """
+    :return: md5 (base64, as API gives it), size and dimensions of attached file, empty dict if post has no file
+    """
+    if not source.get("md5"):
+        return {}
+    return {
+        "md5": source["md5"],
+        "fsize": source.get("fsize", 0),
+        "w": source.get("w", 0),
+        "h": source.get("h", 0)
+    }
 
 
-async def set_archive_mod_date():
-    async with lock:
-        with open("config.json", "r") as file:
-            config = json.load(file)
-        config["archive_modified_date"] = datetime.now().strftime('%a, %d %b %Y %H:%M:%S') + " GMT"
-        with open("config.json", "w") as file:
-            json.dump(config, file)
+def get_now_date() -> str:
+    """
+    :return: current time in HTTP date format, e.g. Wed, 21 Dec 2022 16:40:00 GMT
+    """
+    return formatdate(usegmt=True)
+
+
+def get_timestamp(date: str) -> int:
+    """
+    :param date: date in format of get_now_date, empty string means "never"
+    :return: unix timestamp
+    """
+    if not date:
+        return 0
+    return int(parsedate_to_datetime(date).timestamp())
+
+
+def get_comment(source: dict, keep_refs: bool = False, board: str = DEFAULT_BOARD, keep_media: bool = False) -> dict:
+    """
+    :param source: post from API
+    :param keep_refs: store numbers of quoted posts in "refs"
+    :param board: board of post, used in image link
+    :param keep_media: store md5/fsize/w/h of attached file in "media"
+    :return: reply in no/text/date/img_link shape, "no" is number of post on the board
+    """
+    comment = {
+        "no": source["no"],
+        "text": get_text(source),
+        "date": get_date(source),
+        "img_link": get_image_link(source, board)
+    }
+    if keep_refs:
+        comment["refs"] = get_refs(source)
+    if keep_media:
+        comment["media"] = get_media(source)
+    return comment
+
 
+def get_replies(source: list, keep_refs: bool = False, board: str = DEFAULT_BOARD, keep_media: bool = False) -> list:
+    if "replies" not in source[0]:
+        return []
+    return get_comments(source[1:], keep_refs, board, keep_media)
 
-def get_replies(source: list) -> list:
-    replies = []
-    if "replies" in source[0]:
-        for i in source[1:]:
-            comment = {
-                "text": get_text(i),
-                "date": get_date(i),
-                "img_link": get_image_link(i)
-            }
-            replies.append(comment)
-    return replies
+
+def get_comments(source: list, keep_refs: bool = False, board: str = DEFAULT_BOARD, keep_media: bool = False) -> list:
+    return [get_comment(i, keep_refs, board, keep_media) for i in source]
+
+
+def get_context(posts: list, keep_refs: bool = False, board: str = DEFAULT_BOARD, keep_media: bool = False) -> dict:
+    """
+    :param posts: posts of thread from API
+    :param keep_refs: store numbers of quoted posts in "refs" of every reply
+    :param board: board of thread, used in image links
+    :param keep_media: store md5/fsize/w/h of attached files in "media" of thread and every reply
+    :return: thread in title/text/date/img_link/replies shape
+    """
+    context = {
+        "title": get_title(posts[0]),
+        "text": get_text(posts[0]),
+        "date": get_date(posts[0]),
+        "img_link": get_image_link(posts[0], board),
+        "replies": get_replies(posts, keep_refs, board, keep_media)
+    }
+    if keep_media:
+        context["media"] = get_media(posts[0])
+    return context
+
+
+def new_posts(posts: list, entry: dict) -> list:
+    """
+    :param posts: posts of thread from API, ascending by "no"
+    :param entry: manifest entry of stored thread
+    :return: replies posted after the last stored post, deleted posts don't shift the boundary
+    """
+    if not entry:
+        return posts[1:]
+    if not entry["last_no"]:
+        # entry rebuilt from files saved before replies had numbers, only reply count is known
+        return posts[1 + entry["replies"]:]
+    return posts[bisect_right(posts, entry["last_no"], lo=1, key=lambda post: post["no"]):]
+
+
+def is_sealed(posts: list, location: Location) -> bool:
+    """
+    :return: True if thread is archived, so fetched copy of it is final
+    """
+    return location == Location.ARCHIVE or bool(posts[0].get("archived"))
+
+
+def record_thread(manifest: Manifest, no: int, stored_replies: int, posts: list, last_modified: int = 0,
+                  sealed: bool = False) -> None:
+    """
+    Writes state of stored thread to manifest
+    :param stored_replies: amount of replies in saved file
+    :param posts: posts of thread from API
+    :param last_modified: last_modified of thread from threads.json, if known
+    :param sealed: stored copy is final
+    """
+    manifest.update(no, stored_replies, posts[-1]["no"], max(last_modified, posts[-1].get("time", 0)), sealed)
+
+
+def observe_freshness(posts: list, location: Location, board: Board) -> None:
+    """
+    Freshness lag is time between the newest post of thread and the moment it was saved, it is kept per board shard
+    """
+    if location == Location.CATALOG:
+        lag = time.time() - posts[-1].get("time", time.time())
+        metrics.observe(f"freshness_lag_seconds/{board.key}", lag)
+        metrics.histogram("freshness_lag_seconds", lag, FRESHNESS_BUCKETS, board=board.key)
+
+
+def seal_thread(client: Client, manifest: Manifest, storage: ThreadStorage, no: int, link: str) -> None:
+    """
+    Stops tracking archived thread: replies log is folded into file and validator is dropped, because sealed
+    threads are never requested again
+    """
+    manifest.seal(no)
+    storage.compact(no)
+    client.validators.forget(link)
 
 
-async def create_file(no: int, directory: str, location: Location) -> None:
+async def create_file(client: Client, manifest: Manifest, storage: ThreadStorage, parse_pool: ParsePool, board: Board,
+                      no: int, location: Location, thread_last_mod: int = 0) -> None:
     """
     Creates a file with title, text and link on image of thread and comments with text and image link
+    :param client: shared HTTP client of the run
+    :param manifest: index of stored threads
+    :param storage: storage where to save thread
+    :param parse_pool: parse stage where posts are cleaned and normalised
+    :param board: board of thread
     :param no: index of thread (["no"] parameter in API)
-    :param directory: directory where to save file
     :param location: used in logger to determine what object is being worked on
+    :param thread_last_mod: last_modified of thread from threads.json, if known
     :return: nothing
     """
-    link = fr"https://boards.4channel.org/biz/thread/{no}.json"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(link) as response:
-            try:
-                reply = await response.json()
-            except ContentTypeError as _:
-                log_error(f"Unable to parse JSON from {link}")
-                return
-            context = {
-                "title": get_title(reply["posts"][0]),
-                "text": get_text(reply["posts"][0]),
-                "date": get_date(reply["posts"][0]),
-                "img_link": get_image_link(reply["posts"][0]),
-                "replies": get_replies(reply["posts"])
-            }
-            file_path = os.path.join(directory, f"{no}.json")
-            await async_file_writer(file_path, json.dumps(context))
-            log_message(f"{location.value} | SAVED NEW THREAD | {no}.json")
-            # with open(file_path, "w") as file:
-            #     json.dump(context, file)
-
-
-async def change_comments(no: int, path: str, last_modified: str, location: Location) -> None:
+    link = board.thread_url(no)
+    reply = await client.get_json(link, conditional=True)
+    if not reply:
+        return
+    context = await parse_pool.parse_thread(reply["posts"], board.name)
+    await storage.create(no, context)
+    observe_freshness(reply["posts"], location, board)
+    sealed = is_sealed(reply["posts"], location)
+    record_thread(manifest, no, len(context["replies"]), reply["posts"], thread_last_mod, sealed)
+    if sealed:
+        client.validators.forget(link)
+    else:
+        client.validators.commit(link)
+    log_message(f"{location.value} | SAVED NEW THREAD | {board.name}/{no}.json")
+
+
+async def change_comments(client: Client, manifest: Manifest, storage: ThreadStorage, parse_pool: ParsePool,
+                          board: Board, no: int, last_modified: str, location: Location,
+                          thread_last_mod: int = 0) -> None:
     """
     Adding new comments to file if new where added
+    :param client: shared HTTP client of the run
+    :param manifest: index of stored threads, tells the number of the last saved post
+    :param storage: storage where thread is saved, new replies are appended without reading stored ones
+    :param parse_pool: parse stage where posts are cleaned and normalised
+    :param board: board of thread
     :param last_modified: date of last time modified, example: Wed, 21 Dec 2022 16:40:00 GMT
     :param no: index of thread
-    :param path: directory where file is located
     :param location: used in logger to determine what object is being worked on
+    :param thread_last_mod: last_modified of thread from threads.json, if known
     :return: nothing
     """
-    path = os.path.join(path, f"{no}.json")
-    async with aiofiles.open(path, mode='r') as file:
-        contents = await file.read()
-        thread = json.loads(contents)
-    if last_modified:
+    if last_modified and not last_modified.endswith(" GMT"):
         last_modified += " GMT"
 
-    comments = thread["replies"]
-    link = fr"https://boards.4channel.org/biz/thread/{no}.json"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(link) as reply:
-            try:
-                reply = await reply.json()
-            except ContentTypeError as _:
-                log_error(f"Unable to parse JSON from {link}")
-                return
-            reply = reply["posts"][1:]
-            local_rep = len(comments)
-            real_rep = len(reply)
-            if real_rep > local_rep:
-                for i in reply[local_rep:]:
-                    comment = {
-                        "text": get_text(i),
-                        "date": get_date(i),
-                        "img": get_image_link(i)
-                    }
-                    comments.append(comment)
-                thread["replies"] = comments
-                await async_file_writer(path, json.dumps(thread))
-                log_message(f"{location.value} | THREAD UPDATED | {no}.json")
-
-
-async def analyze_pages(reply: list, directory: str, last_modified: str, catalog_last_mod: int,
-                        threads_mod_date: dict = None) -> None:
-    for page in reply:
-        for thread in page["threads"]:
-            # start = time.time()
-            no = thread["no"]
-            # Тут была проблема, что если тред не был изменен, скрапер все равно делал запрос, чтобы убедиться в этом
-            path = os.path.join(directory, f"{no}.json")
-            if threads_mod_date:
-                seconds_since_thread_changed = threads_mod_date[no] - catalog_last_mod
-                if seconds_since_thread_changed > 0:
-                    if os.path.exists(path):
-                        await change_comments(no, directory, last_modified, Location.CATALOG)
-                    else:
-                        await create_file(no, directory, Location.CATALOG)
-            # sleep = 1 - (time.time() - start) if (1 - (time.time() - start)) > 0 else 0
-            # time.sleep(sleep)
-
-
-async def extract_threads_mod_time(pages: list) -> dict:
-    result = {}
-    for page in pages:
-        for thread in page['threads']:
-            result[thread["no"]] = thread["last_modified"]
-    return result
-
-
-async def check_catalog() -> None:
-    """
-    :return: updates files from catalog
-    """
-    async with lock:
-        with open("config.json", "r") as file:
-            config = json.load(file)
-    directory = config["folder_path"]
-    last_modified = config["catalog_modified_date"]
-    dt = datetime.strptime(last_modified, "%a, %d %b %Y %H:%M:%S %Z")
-    catalog_mod_timestamp = int(dt.timestamp())
-
-    await set_catalog_mod_date()
-    async with aiohttp.ClientSession() as session:
-
-        async with session.get(CATALOG_MODIFIED) as response:
-            json_data = await response.json()
-            tasks = []
-            for i in range(0, len(json_data), len(json_data) // TASKS_AMOUNT + 1):
-                pages = json_data[i:min(i + len(json_data) // TASKS_AMOUNT + 1, len(json_data))]
-                tasks.append(asyncio.create_task(extract_threads_mod_time(pages)))
-            results = await asyncio.gather(*tasks)
-            threads_mod_date = {}
-            for result in results:
-                threads_mod_date.update(result)
-
-        async with session.get(CATALOG) as response:
-            reply = await response.json()
-            tasks = []
-            for i in range(0, len(reply), len(reply) // TASKS_AMOUNT + 1):
-                pages = reply[i:min(i + len(reply) // TASKS_AMOUNT + 1, len(reply))]
-                tasks.append(asyncio.create_task(analyze_pages(pages, directory, last_modified, catalog_mod_timestamp,
-                                                               threads_mod_date)))
-            await asyncio.gather(*tasks)
-
-
-async def analyze_archive(ids: list, directory: str, last_modified: str) -> None:
-    # start = time.time()
+    link = board.thread_url(no)
+    # unchanged thread is answered with empty 304 and neither the response nor the local file is parsed
+    had_validator = link in client.validators
+    # 304 to the fallback date alone doesn't prove that stored copy is complete (e.g. manifest rebuilt from files after
+    # an upgrade), archived thread without validator of its own is requested in full once and sealed
+    conditional = had_validator or location != Location.ARCHIVE
+    reply = await client.get_json(link, conditional=conditional, fallback_date=last_modified if conditional else "")
+    if reply is NOT_MODIFIED and had_validator and location == Location.ARCHIVE:
+        # thread didn't change since we stored it and it is archived now, so stored copy is final
+        seal_thread(client, manifest, storage, no, link)
+        return
+    if not reply:
+        return
+    posts = reply["posts"]
+    entry = manifest.get(no)
+    local_rep = entry["replies"] if entry else 0
+    fresh = new_posts(posts, entry)
+    if fresh:
+        comments = await parse_pool.parse_comments(fresh, board.name)
+        await storage.append(no, comments)
+        observe_freshness(posts, location, board)
+        local_rep += len(comments)
+        log_message(f"{location.value} | THREAD UPDATED | {board.name}/{no}.json")
+    record_thread(manifest, no, local_rep, posts, thread_last_mod)
+    if is_sealed(posts, location):
+        seal_thread(client, manifest, storage, no, link)
+    else:
+        client.validators.commit(link)
+
+
+async def fetch_thread(client: Client, manifest: Manifest, storage: ThreadStorage, parse_pool: ParsePool, board: Board,
+                       no: int, last_modified: str, location: Location, thread_last_mod: int = 0) -> None:
+    """
+    Saves new thread or appends new replies of stored one, sealed threads are skipped. The thread is held from the
+    request to the manifest update, so catalog check and archive pass never fetch and append the same replies at once,
+    and what to do is decided by the manifest entry left by whichever of them came first
+    """
+    async with manifest.locked(no):
+        entry = manifest.get(no)
+        if entry is None:
+            await create_file(client, manifest, storage, parse_pool, board, no, location, thread_last_mod)
+        elif not entry["sealed"]:
+            await change_comments(client, manifest, storage, parse_pool, board, no, last_modified, location,
+                                  thread_last_mod)
+
+
+async def analyze_pages(client: Client, manifest: Manifest, storage: ThreadStorage, parse_pool: ParsePool,
+                        board: Board, scheduler: RefreshScheduler, plan: CatalogPlan, last_modified: str,
+                        threads_mod_date: dict) -> bool:
+    """
+    :param plan: new and changed threads of the shard (see CatalogPlanner)
+    :param scheduler: without one every new and changed thread is fetched
+    :return: True if every new or changed thread was fetched, False if scheduler deferred some of them or some failed
+    """
+    new, changed = plan.new, plan.changed
+    # threads are fetched by the worker pool in order of the plan, the client's semaphore limits how many are in flight
+    queue = WorkQueue(f"{Location.CATALOG.value}/{board.key}")
+    planned = scheduler.plan(new, changed) if scheduler is not None else new + changed
+    for priority, no in enumerate(planned):
+        queue.put(partial(fetch_thread, client, manifest, storage, parse_pool, board, no, last_modified,
+                          Location.CATALOG, threads_mod_date.get(no) or 0), priority)
+    done = await queue.run()
+    return done and len(planned) == len(new) + len(changed)
+
+
+def extract_threads_mod_time(page: dict) -> dict:
+    return {thread["no"]: thread.get("last_modified") for thread in page['threads']}
+
+
+async def stream_threads_mod_time(client: Client, board: Board) -> tuple:
+    """
+    Pages of threads.json are taken apart while it is downloaded
+    :return: result of conditional request (see Client.stream_json), pages and last_modified of every listed thread
+    """
+    pages = []
+    threads_mod_date = {}
+
+    def on_page(page: dict) -> None:
+        pages.append(page)
+        threads_mod_date.update(extract_threads_mod_time(page))
+
+    result = await client.stream_json(board.threads_url, on_page, conditional=True)
+    return result, pages, threads_mod_date
+
+
+async def check_catalog(client: Client, manifest: Manifest, storage: ThreadStorage, parse_pool: ParsePool,
+                        board: Board, checkpoint: Checkpoint, scheduler: RefreshScheduler = None) -> int:
+    """
+    Catalog check: only threads.json is requested (conditionally), new threads and threads whose last_modified moved
+    since they were stored are fetched. catalog.json is requested only if threads.json doesn't have last_modified of
+    some thread (see CatalogPlanner)
+    :param client: shared HTTP client of the run
+    :param manifest: index of stored threads
+    :param storage: storage of threads
+    :param parse_pool: parse stage where posts are cleaned and normalised
+    :param board: board shard to check
+    :param checkpoint: keeps modification date of previous catalog check
+    :param scheduler: decides which changed threads are fetched and in which order, it's kept by the daemon only
+        (see RefreshScheduler), one-shot run fetches every changed thread
+    :return: amount of threads listed in threads.json, 0 if it wasn't modified
+    """
+    last_modified = checkpoint.get("catalog_modified_date")
+    catalog_mod_timestamp = get_timestamp(last_modified)
+    check_started = get_now_date()
+
+    result, pages, threads_mod_date = await stream_threads_mod_time(client, board)
+    if not result:
+        return 0
+    if scheduler is not None:
+        scheduler.observe(pages)
+    planner = CatalogPlanner(manifest, board)
+    plan = planner.plan(threads_mod_date, catalog_mod_timestamp)
+    if plan.needs_catalog:
+        catalog_mod_date = {}
+        if not await client.stream_json(board.catalog_url,
+                                        lambda page: catalog_mod_date.update(extract_threads_mod_time(page))):
+            return 0
+        checkpoint.set("catalog_bytes", client.received[board.catalog_url])
+        threads_mod_date.update({no: catalog_mod_date.get(no) for no in plan.unknown})
+        plan = planner.plan(threads_mod_date, catalog_mod_timestamp, catalog_fetched=True)
+    saved_requests, saved_bytes = planner.report(plan, checkpoint.get("catalog_bytes"))
+    log_message(f"{Location.CATALOG.value} | PLAN | {board.key} | {len(plan.new)} new, {len(plan.changed)} changed, "
+                f"{plan.unchanged} unchanged | threads.json {client.received.get(board.threads_url, 0)} bytes, "
+                f"saved {saved_requests} requests, {saved_bytes} bytes")
+    # all pages are planned at once, so the scheduler sees the whole catalog
+    complete = await analyze_pages(client, manifest, storage, parse_pool, board, scheduler, plan, last_modified,
+                                   threads_mod_date)
+    manifest.flush()
+    # with deferred threads left, next check must get full threads.json instead of 304
+    if complete:
+        client.validators.commit(board.threads_url)
+    checkpoint.set("catalog_modified_date", check_started)
+    return len(threads_mod_date)
+
+
+async def archive_thread(client: Client, manifest: Manifest, storage: ThreadStorage, parse_pool: ParsePool,
+                         board: Board, checkpoint: Checkpoint, no: int, last_modified: str) -> None:
+    # one final fetch of thread that moved from catalog to archive, after that it is sealed
+    await fetch_thread(client, manifest, storage, parse_pool, board, no, last_modified, Location.ARCHIVE)
+    checkpoint.complete(no)
+
+
+async def analyze_archive(client: Client, manifest: Manifest, storage: ThreadStorage, parse_pool: ParsePool,
+                          board: Board, checkpoint: Checkpoint, ids: list, last_modified: str) -> bool:
+    """
+    :param ids: threads of the pass, they are taken by the worker pool in order
+    :return: True if every thread was archived
+    """
+    queue = WorkQueue(f"{Location.ARCHIVE.value}/{board.key}")
     for no in ids:
-        if os.path.exists(os.path.join(directory, f"{no}.json")):
-            await change_comments(no, directory, last_modified, Location.ARCHIVE)
-        else:
-            await create_file(no, directory, Location.ARCHIVE)
-        # sleep = 1 - (time.time() - start) if (1 - (time.time() - start)) > 0 else 0
-        # time.sleep(sleep + 0.01)
+        queue.put(partial(archive_thread, client, manifest, storage, parse_pool, board, checkpoint, no, last_modified))
+    return await queue.run()
 
 
-async def archive_rec() -> None:
+async def archive_rec(client: Client, manifest: Manifest, storage: ThreadStorage, parse_pool: ParsePool,
+                      board: Board, checkpoint: Checkpoint) -> None:
     """
-    Updating archived threads
+    Updating archived threads. Ids of the pass are kept in durable queue, so interrupted pass is resumed by next run
+    :param client: shared HTTP client of the run
+    :param manifest: index of stored threads
+    :param storage: storage of threads
+    :param parse_pool: parse stage where posts are cleaned and normalised
+    :param board: board shard to update, ids of other shards are skipped
+    :param checkpoint: durable queue of the pass and modification date of previous pass
     :return: nothing
     """
-    async with lock:
-        with open("config.json", "r") as file:
-            config = json.load(file)
-    last_local_thread = config["last_archive_element"]
-    last_modified = config["archive_modified_date"]
-    await set_archive_mod_date()
-    async with aiohttp.ClientSession() as session:
-        async with session.get(ARCHIVE) as response:
-            reply = await response.json()
-
-            if last_local_thread not in reply:
-                last_local_thread = reply[0]
-
-            diff = (reply[-1] - last_local_thread) / TASKS_AMOUNT
-
-            tasks = []
-            for i in range(TASKS_AMOUNT):
-                upper_limit = reply[-1] - i * diff
-                lower_limit = upper_limit - diff
-                worker_tasks = [value for value in reply if lower_limit <= value < upper_limit]
-                tasks.append(asyncio.create_task(analyze_archive(worker_tasks, config["folder_path"], last_modified)))
-            await asyncio.gather(*tasks)
-
-            config["last_archive_element"] = reply[-1]
-
-            # last_local_thread_index = reply.index(last_local_thread)
-            # unmarked_ids = len(reply) - 1 - last_local_thread_index
-            # for i in range(last_local_thread_index + 1, len(reply), unmarked_ids // TASKS_AMOUNT + 1):
-            #     ids = reply[i:min(i + unmarked_ids // TASKS_AMOUNT + 1, len(reply))]
-            #     tasks.append(asyncio.create_task(analyze_archive(ids, config["folder_path"], last_modified)))
-            # async with lock:
-            #     with open("config.json", "w") as file:
-            #         json.dump(config, file)
+    last_modified = checkpoint.get("archive_modified_date")
+    pass_started = get_now_date()
+    batch = []
+    last_id = 0
+
+    def on_id(no: int) -> None:
+        nonlocal last_id
+        last_id = no
+        if board.owns(no) and not (no in manifest and manifest.get(no)["sealed"]):
+            batch.append(no)
+        if len(batch) >= ENQUEUE_BATCH:
+            checkpoint.enqueue(batch)
+            batch.clear()
+
+    reply = await client.stream_json(board.archive_url, on_id, conditional=True)
+    checkpoint.enqueue(batch)
+    if reply is None:
+        return
+
+    ids = checkpoint.pending()
+    if not ids and reply is NOT_MODIFIED:
+        return
+    if reply is NOT_MODIFIED:
+        log_message(f"{Location.ARCHIVE.value} | RESUMING PASS | {len(ids)} threads left")
+
+    if not await analyze_archive(client, manifest, storage, parse_pool, board, checkpoint, ids, last_modified):
+        # failed threads stay pending, next run resumes the pass with them
+        checkpoint.flush()
+        log_message(f"{Location.ARCHIVE.value} | PASS INCOMPLETE | {len(checkpoint.pending())} threads left")
+        return
+    checkpoint.finish_pass()
+    checkpoint.set("archive_modified_date", pass_started)
+    if reply is not NOT_MODIFIED:
+        client.validators.commit(board.archive_url)
+        checkpoint.set("last_archive_element", last_id)
+
+
+async def board_daemon(config: dict, board: Board, parse_pool: ParsePool, rate_limiter: RateLimiter) -> None:
+    """
+    Long-running mode of one board shard: threads.json is polled every `poll_interval` seconds, archive pass runs in
+    background every `archive_interval` seconds
+    :param config: config of board shard (see Board.config)
+    """
+    make_directories(config)
+    poll_interval = config.get("poll_interval", POLL_INTERVAL)
+    archive_interval = config.get("archive_interval", ARCHIVE_INTERVAL)
+    storage = open_storage(config)
+    manifest = Manifest.open(config.get("manifest_path", MANIFEST_PATH), storage)
+    checkpoint = Checkpoint.open(manifest, config)
+    scheduler = RefreshScheduler.from_config(config)
+    lag_metric = f"freshness_lag_seconds/{board.key}"
+    archive_task = None
+    next_archive = 0.0
+    downloader = MediaDownloader.from_config(config) if config.get("download_media") else None
+    media_task = asyncio.create_task(downloader.run()) if downloader is not None else None
+    try:
+        async with Client.from_config(config, rate_limiter) as client:
+            while True:
+                started = time.monotonic()
+                if archive_task is not None and archive_task.done():
+                    if not archive_task.cancelled() and archive_task.exception():
+                        log_error(archive_task.exception())
+                    archive_task = None
+                if started >= next_archive and archive_task is None:
+                    archive_task = asyncio.create_task(archive_rec(client, manifest, storage, parse_pool, board,
+                                                                   checkpoint))
+                    next_archive = started + archive_interval
+                try:
+                    with metrics.timer("phase_seconds", phase="poll", board=board.key):
+                        listed = await check_catalog(client, manifest, storage, parse_pool, board, checkpoint,
+                                                     scheduler)
+                except Exception as e:  # NOQA
+                    log_error(e)
+                    listed = 0
+                lag = metrics.summary(lag_metric)
+                if listed:
+                    log_message(f"{Location.CATALOG.value} | POLLED | {board.key} | {listed} threads | freshness lag "
+                                f"p50 {lag.get('p50', 0):.1f}s max {lag.get('max', 0):.1f}s")
+                metrics.reset(lag_metric)
+                client.validators.save()
+                await asyncio.sleep(max(0.0, poll_interval - (time.monotonic() - started)))
+    finally:
+        for task in (archive_task, media_task):
+            if task is not None and not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        checkpoint.flush()
+        manifest.close()
+        storage.close()
+        if downloader is not None:
+            downloader.close()
+
+
+async def daemon(worker: int = 0, workers: int = 1) -> None:
+    """
+    Long-running mode: every board shard of the worker is polled by its own loop, all of them share parse pool and
+    rate limiter of the process
+    :param worker: index of worker process
+    :param workers: total amount of worker processes
+    """
+    with open("config.json", "r") as file:
+        config = json.load(file)
+    logger.configure(config)
+    rate_limiter = RateLimiter.from_config(config)
+    server = await start_server(config, worker)
+    try:
+        async with ParsePool.from_config(config) as parse_pool:
+            await asyncio.gather(*(board_daemon(board.config(config), board, parse_pool, rate_limiter)
+                                   for board in assigned_boards(config, worker, workers)))
+    finally:
+        rate_limiter.close()
+        if server is not None:
+            await server.stop()
+        if summary_path(config, worker, workers):
+            metrics.dump(summary_path(config, worker, workers))
 
 
 def time_it(func):
@@ -284,23 +545,77 @@ def time_it(func):
         start = time.time()
         await func(*args, **kwargs)
         end = time.time()
+        metrics.histogram("run_seconds", end - start, (60, 300, 900, 1800, 3600, 7200))
         log_message('Elapsed time of async version code: {}'.format(end - start))
 
     return wrapper
 
 
-@time_it
-async def main():
+async def scrape_board(config: dict, board: Board, parse_pool: ParsePool, rate_limiter: RateLimiter) -> None:
+    """
+    One catalog check and archive pass of board shard, with `download_media` queued files are downloaded meanwhile and
+    the pass ends when the queue is empty
+    :param config: config of board shard (see Board.config)
+    """
     try:
-        with open("config.json", "r") as file:
-            directory = json.load(file)["folder_path"]
-        if not os.path.exists(directory):
-            os.mkdir(directory)
+        make_directories(config)
     except Exception as _:  # NOQA
         log_error("Problems with given directory")
+    storage = open_storage(config)
+    manifest = Manifest.open(config.get("manifest_path", MANIFEST_PATH), storage)
+    checkpoint = Checkpoint.open(manifest, config)
+    downloader = MediaDownloader.from_config(config) if config.get("download_media") else None
+    scraped = asyncio.Event()
+    media_task = asyncio.create_task(downloader.run(scraped)) if downloader is not None else None
+    try:
+        async with Client.from_config(config, rate_limiter) as client:
+            with metrics.timer("phase_seconds", phase="catalog", board=board.key):
+                await check_catalog(client, manifest, storage, parse_pool, board, checkpoint)
+            with metrics.timer("phase_seconds", phase="archive", board=board.key):
+                await archive_rec(client, manifest, storage, parse_pool, board, checkpoint)
+        scraped.set()
+        if media_task is not None:
+            await media_task
+    finally:
+        if media_task is not None and not media_task.done():
+            media_task.cancel()
+            await asyncio.gather(media_task, return_exceptions=True)
+        checkpoint.flush()
+        manifest.close()
+        storage.close()
+        if downloader is not None:
+            downloader.close()
+
+
+@time_it
+async def main(worker: int = 0, workers: int = 1):
+    """
+    :param worker: index of worker process
+    :param workers: total amount of worker processes, board shards are split between them by consistent hashing
+    """
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+        logger.configure(config)
+        rate_limiter = RateLimiter.from_config(config)
+    except Exception as e:  # NOQA
+        log_error(e)
+        return
+    server = None
     try:
-        await check_catalog()
-        await archive_rec()
+        server = await start_server(config, worker)
+        async with ParsePool.from_config(config) as parse_pool:
+            boards = assigned_boards(config, worker, workers)
+            results = await asyncio.gather(*(scrape_board(board.config(config), board, parse_pool, rate_limiter)
+                                             for board in boards), return_exceptions=True)
+            for board, result in zip(boards, results):
+                if isinstance(result, Exception):
+                    log_error(f"{board.key} | {result}")
     except Exception as e:  # NOQA
         log_error(e)
-        pass
+    finally:
+        rate_limiter.close()
+        if server is not None:
+            await server.stop()
+        if summary_path(config, worker, workers):
+            metrics.dump(summary_path(config, worker, workers))
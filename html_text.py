@@ -0,0 +1,46 @@
+import html
+import re
+
+# links (quotelinks >>123 included) are removed together with their text, other tags are removed alone
+MARKUP = re.compile(r'<a\b[^>]*>.*?</a>|<[^>]*>', re.DOTALL)
+QUOTELINK = re.compile(r'<a href="[^"#]*#p(\d+)" class="quotelink">')
+ENTITY = re.compile(r'&#?\w+;')
+
+
+def html_to_text(raw_html: str) -> str:
+    """
+    Converts post body to text. Every step is a linear pass done by the regex engine or str methods in C, plain
+    posts skip the steps they don't need
+    :param raw_html: html code of post
+    :return: text without html code and symbols, <br> becomes new line, greentext keeps its ">"
+    """
+    text = raw_html
+    if "<" in text:
+        text = MARKUP.sub("", text.replace("<br>", "\n"))
+    if "&" in text:
+        # entities 4chan actually emits are replaced directly, &amp; goes last so "&amp;gt;" stays "&gt;"
+        text = text.replace("&gt;", ">").replace("&lt;", "<").replace("&quot;", '"').replace("&#039;", "'")
+        if "&" in text:
+            if ENTITY.search(text.replace("&amp;", "")):
+                text = html.unescape(text)
+            else:
+                text = text.replace("&amp;", "&")
+    return text
+
+
+def get_quote_refs(raw_html: str) -> list:
+    """
+    :param raw_html: html code of post
+    :return: numbers of posts the post quotes, in order of appearance
+    """
+    if "quotelink" not in raw_html:
+        return []
+    return [int(no) for no in QUOTELINK.findall(raw_html)]
+
+
+def html_to_text_and_refs(raw_html: str) -> tuple:
+    """
+    :param raw_html: html code of post
+    :return: text as in html_to_text and list of post numbers the post quotes
+    """
+    return html_to_text(raw_html), get_quote_refs(raw_html)
@@ -1,4 +1,14 @@
+import atexit
+import json
 import logging
+import random
+import threading
+import time
+from logging.handlers import QueueHandler
+from queue import Empty, SimpleQueue
+
+# records written to handlers at once by the background writer
+LOG_BATCH_SIZE = 256
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -18,6 +28,193 @@ logger.addHandler(console_handler)
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
+writer = None
+configured = False
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One compact JSON object per record: {"time", "level", "logger", "message"} and "exc" if there is a traceback
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Thins out chatty records (e.g. one INFO per saved thread). WARNING and above always pass, records of levels in
+    `rates` pass with that probability, and at most `per_second` records below WARNING pass per second. Amount of
+    dropped records is added to the next record that passes.
+    """
+
+    def __init__(self, rates: dict = None, per_second: float = 0):
+        """
+        :param rates: share of records kept by level name, e.g. {"INFO": 0.1}
+        :param per_second: limit of records below WARNING per second, 0 is no limit
+        """
+        super().__init__()
+        self.rates = {logging.getLevelName(level): rate for level, rate in (rates or {}).items()}
+        self.per_second = per_second
+        self.tokens = per_second
+        self.updated = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return self._passed(record)
+        rate = self.rates.get(record.levelno, 1.0)
+        if rate < 1 and random.random() >= rate:
+            self.dropped += 1
+            return False
+        if self.per_second:
+            now = time.monotonic()
+            self.tokens = min(self.per_second, self.tokens + (now - self.updated) * self.per_second)
+            self.updated = now
+            if self.tokens < 1:
+                self.dropped += 1
+                return False
+            self.tokens -= 1
+        return self._passed(record)
+
+    def _passed(self, record: logging.LogRecord) -> bool:
+        if self.dropped:
+            record.msg = f"{record.getMessage()} ({self.dropped} messages dropped by sampling)"
+            record.args = None
+            self.dropped = 0
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    """
+    Queues records without formatting them, only arguments and traceback are turned into text (they may not
+    survive until the writer gets to the record), formatting is left to the writer thread
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class BatchWriter(threading.Thread):
+    """
+    Background thread that takes queued records and writes whatever has piled up (up to `batch_size` records) to
+    every handler with one write and one flush, so the event loop only puts records into the queue
+    """
+
+    _stop_record = object()
+
+    def __init__(self, queue: SimpleQueue, handlers: list, batch_size: int = LOG_BATCH_SIZE):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if batch[-1] is self._stop_record:
+                batch.pop()
+                stopping = True
+            self._write(batch)
+
+    def _write(self, batch: list) -> None:
+        for handler in self.handlers:
+            lines = []
+            for record in batch:
+                if record.levelno < handler.level:
+                    continue
+                try:
+                    lines.append(handler.format(record) + handler.terminator)
+                except Exception:  # NOQA
+                    handler.handleError(record)
+            if not lines:
+                continue
+            handler.acquire()
+            try:
+                handler.stream.write("".join(lines))
+                handler.flush()
+            except Exception:  # NOQA
+                handler.handleError(batch[0])
+            finally:
+                handler.release()
+
+    def stop(self) -> None:
+        self.queue.put(self._stop_record)
+        self.join()
+
+
+def configure(config: dict) -> None:
+    """
+    Applies logging settings of config.json, repeated calls keep the first setup
+    :param config: `log_format` "text" (default) or "json", `log_sample_rates` (e.g. {"INFO": 0.1}) and
+        `log_rate_limit` (records below WARNING per second) thin out chatty records, with `log_queue` records are
+        handed to a background thread that writes them in batches instead of blocking the caller on file and
+        console writes
+    """
+    global writer, configured
+    if configured:
+        return
+    configured = True
+    if config.get("log_format") == "json":
+        for handler in (file_handler, console_handler):
+            handler.setFormatter(JsonFormatter())
+    sampling = None
+    if config.get("log_sample_rates") or config.get("log_rate_limit"):
+        sampling = SamplingFilter(config.get("log_sample_rates"), config.get("log_rate_limit", 0))
+    if not config.get("log_queue"):
+        if sampling is not None:
+            logger.addFilter(sampling)
+        return
+    handlers = [handler for handler in (file_handler, console_handler) if handler in logger.handlers]
+    queue = SimpleQueue()
+    queue_handler = _QueueHandler(queue)
+    if sampling is not None:
+        queue_handler.addFilter(sampling)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    writer = BatchWriter(queue, handlers)
+    writer.start()
+    atexit.register(stop)
+
+
+def stop() -> None:
+    """
+    Writes records that are still queued, logging goes back to direct handlers
+    """
+    global writer, configured
+    configured = False
+    if writer is None:
+        return
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+    writer.stop()
+    for handler in writer.handlers:
+        logger.addHandler(handler)
+    writer = None
+
 
 def log_message(message):
     logging.info(message)
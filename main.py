@@ -1,32 +1,140 @@
+import argparse
 import asyncio
+import cProfile
+import io
+import json
+import multiprocessing
 import os
+import pstats
 import shutil
 
 import schedule
 import time
 
-from fixed_functions import main as async_main
+from boards import assigned_boards
+from fixed_functions import main as async_main, daemon as async_daemon
 from functions import main as sync_main
-from logger import log_message
+import logger
+from logger import log_message, log_error
 
+# how often supervisor checks that worker processes are alive
+SUPERVISE_INTERVAL = 5
+# functions listed in the log after a profiled run
+PROFILE_TOP = 30
 
-def scrape_async():
-    asyncio.run(async_main())
 
+def scrape_async(worker: int = 0, workers: int = 1):
+    asyncio.run(async_main(worker, workers))
 
-if __name__ == "__main__":
+
+def run_worker(worker: int, workers: int, daemon: bool) -> None:
+    """
+    Scrapes board shards of one worker, runs in worker process or in the main one if there is a single worker
+    """
+    try:
+        if daemon:
+            asyncio.run(async_daemon(worker, workers))
+        else:
+            # print('Async version ARCHIVE threads collecting:')
+            scrape_async(worker, workers)
+            # sync version of scraper
+            # if os.path.exists('threads'):
+            #     shutil.rmtree('threads')
+            # print('Sync version ARCHIVE threads collecting:')
+            # sync_main()
+            # schedule.every().hour.do(sync_main)
+            schedule.every().hour.do(scrape_async, worker, workers)
+            while True:
+                schedule.run_pending()
+                time.sleep(1)
+    except KeyboardInterrupt:
+        log_message("TERMINATED")
+    finally:
+        # worker processes exit without atexit hooks, queued records are written here
+        logger.stop()
+
+
+def profile_run(path: str, worker: int = 0, workers: int = 1) -> None:
+    """
+    One scrape pass under cProfile, stats are written to path (pstats format, e.g. for snakeviz) and the functions
+    with the largest cumulative time are logged. Parsing runs in other processes unless parse_workers is 0
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        scrape_async(worker, workers)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        log_message(f"PROFILE | {path}\n{stream.getvalue()}")
+
+
+def busy_workers(config: dict, first_worker: int, local_workers: int, workers: int) -> list:
+    """
+    :return: indexes of workers of this host that have board shards, with more workers than shards some have none
+    """
+    return [worker for worker in range(first_worker, first_worker + local_workers)
+            if assigned_boards(config, worker, workers)]
+
+
+def supervise(local_workers: list, workers: int, daemon: bool) -> None:
+    """
+    Starts worker processes of this host and restarts the ones that die
+    :param local_workers: indexes of workers of this host that have board shards (see busy_workers)
+    :param workers: amount of worker processes on all hosts
+    """
+    processes = {}
     try:
-        # print('Async version ARCHIVE threads collecting:')
-        scrape_async()
-        # sync version of scraper
-        # if os.path.exists('threads'):
-        #     shutil.rmtree('threads')
-        # print('Sync version ARCHIVE threads collecting:')
-        # sync_main()
-        # schedule.every().hour.do(sync_main)
-        schedule.every().hour.do(scrape_async)
         while True:
-            schedule.run_pending()
-            time.sleep(1)
+            for worker in local_workers:
+                process = processes.get(worker)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    log_error(f"WORKER {worker} EXITED WITH CODE {process.exitcode} | RESTARTING")
+                process = multiprocessing.Process(target=run_worker, args=(worker, workers, daemon),
+                                                  name=f"worker-{worker}")
+                process.start()
+                processes[worker] = process
+            time.sleep(SUPERVISE_INTERVAL)
     except KeyboardInterrupt:
+        for process in processes.values():
+            process.terminate()
+            process.join()
         log_message("TERMINATED")
+
+
+if __name__ == "__main__":
+    with open("config.json", "r") as file:
+        config = json.load(file)
+    parser = argparse.ArgumentParser(description="4chan scraper")
+    parser.add_argument("--daemon", action="store_true",
+                        help="poll threads.json every poll_interval seconds instead of hourly full runs")
+    parser.add_argument("--workers", type=int, default=config.get("workers", 1),
+                        help="amount of worker processes on this host")
+    parser.add_argument("--first-worker", type=int, default=0,
+                        help="index of the first worker of this host, when workers run on several hosts")
+    parser.add_argument("--total-workers", type=int,
+                        help="amount of workers on all hosts, by default first worker index + workers")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="run one pass of the first worker of this host that has board shards under cProfile "
+                             "and write stats to PATH")
+    args = parser.parse_args()
+    total_workers = args.total_workers or args.first_worker + args.workers
+    if args.workers == 1 and total_workers == 1:
+        busy = [0]
+    else:
+        busy = busy_workers(config, args.first_worker, args.workers, total_workers)
+        if len(busy) < args.workers:
+            log_message(f"SUPERVISOR | {args.workers - len(busy)} of {args.workers} workers of this host have no board "
+                        f"shards and aren't started")
+    if not busy:
+        log_error("No worker of this host has board shards")
+    elif args.profile:
+        profile_run(args.profile, busy[0], total_workers)
+    elif total_workers == 1:
+        run_worker(0, 1, args.daemon)
+    else:
+        supervise(busy, total_workers, args.daemon)
@@ -0,0 +1,143 @@
+import asyncio
+import sqlite3
+from contextlib import asynccontextmanager
+
+from logger import log_message, log_error
+from storage import ThreadStorage
+
+MANIFEST_PATH = "manifest.sqlite3"
+FLUSH_EVERY = 500
+
+
+class Manifest:
+    """
+    Compact index of stored threads keyed by thread no.
+    Every entry keeps reply count, no of the last stored post, last modification timestamp and sealed flag (thread
+    was already archived when it was stored, so stored copy is final). Whole table is loaded once per run, decisions
+    are made in memory and changes are written back in batched transactions.
+    """
+
+    def __init__(self, path: str = MANIFEST_PATH, storage: ThreadStorage = None):
+        self.path = path
+        self.storage = storage
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            "no INTEGER PRIMARY KEY, "
+            "replies INTEGER NOT NULL, "
+            "last_no INTEGER NOT NULL, "
+            "last_modified INTEGER NOT NULL, "
+            "sealed INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.connection.commit()
+        self.entries = {}
+        self.dirty = set()
+        # lock and amount of its holders by thread no, only threads being worked on have one
+        self.locks = {}
+
+    @classmethod
+    def open(cls, path: str, storage: ThreadStorage) -> "Manifest":
+        """
+        :param path: sqlite file of manifest
+        :param storage: storage of threads, scanned once if manifest is empty, flushed before manifest changes
+        :return: loaded manifest
+        """
+        manifest = cls(path, storage)
+        for no, replies, last_no, last_modified, sealed in manifest.connection.execute(
+                "SELECT no, replies, last_no, last_modified, sealed FROM threads"):
+            manifest.entries[no] = {
+                "replies": replies,
+                "last_no": last_no,
+                "last_modified": last_modified,
+                "sealed": bool(sealed)
+            }
+        if not manifest.entries:
+            manifest.rebuild()
+        return manifest
+
+    def rebuild(self) -> None:
+        """
+        Fills manifest from threads already saved in storage
+        :return: nothing
+        """
+        for no in self.storage.threads():
+            try:
+                thread = self.storage.read(no)
+            except (KeyError, OSError, ValueError) as _:
+                log_error(f"Unable to index thread {no}")
+                continue
+            replies = thread.get("replies", [])
+            # replies saved before they had numbers leave last_no unknown, the thread is then merged by reply count
+            last_no = replies[-1].get("no", 0) if replies else no
+            self.update(no, len(replies), last_no, self.storage.modified(no))
+        self.flush()
+        log_message(f"MANIFEST | REBUILT FROM STORAGE | {len(self.entries)} threads")
+
+    def get(self, no: int) -> dict:
+        return self.entries.get(no)
+
+    def __contains__(self, no: int) -> bool:
+        return no in self.entries
+
+    def update(self, no: int, replies: int, last_no: int, last_modified: int, sealed: bool = False) -> None:
+        self.entries[no] = {
+            "replies": replies,
+            "last_no": last_no,
+            "last_modified": last_modified,
+            "sealed": sealed
+        }
+        self.dirty.add(no)
+        if len(self.dirty) >= FLUSH_EVERY:
+            self.flush()
+
+    @asynccontextmanager
+    async def locked(self, no: int):
+        """
+        Holds thread while it is fetched, saved and recorded, so two passes over the same threads (catalog check and
+        archive pass of daemon) work on one thread in turn and the second one sees what the first one stored
+        """
+        lock, holders = self.locks.get(no, (None, 0))
+        lock = lock or asyncio.Lock()
+        self.locks[no] = (lock, holders + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, holders = self.locks[no]
+            if holders == 1:
+                del self.locks[no]
+            else:
+                self.locks[no] = (lock, holders - 1)
+
+    def seal(self, no: int) -> None:
+        """
+        Marks stored copy of thread as final, sealed threads are never fetched again
+        """
+        entry = self.entries[no]
+        self.update(no, entry["replies"], entry["last_no"], entry["last_modified"], True)
+
+    def flush(self) -> None:
+        """
+        Writes changed entries in one transaction, storage is flushed first so manifest never points at replies that
+        aren't written
+        """
+        if not self.dirty:
+            return
+        if self.storage is not None:
+            self.storage.flush()
+        rows = []
+        for no in self.dirty:
+            entry = self.entries[no]
+            rows.append((no, entry["replies"], entry["last_no"], entry["last_modified"], int(entry["sealed"])))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO threads (no, replies, last_no, last_modified, sealed) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(no) DO UPDATE SET replies = excluded.replies, last_no = excluded.last_no, "
+                "last_modified = excluded.last_modified, sealed = excluded.sealed",
+                rows
+            )
+        self.dirty.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,256 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import sqlite3
+
+import aiohttp
+
+from logger import log_error, log_message
+from rate_limiter import RateLimiter, THROTTLE_STATUSES, parse_retry_after
+from storage import StorageWrapper, ThreadStorage
+
+MEDIA_PATH = "media"
+MEDIA_QUEUE_PATH = "media.sqlite3"
+MEDIA_CONCURRENCY = 4
+MEDIA_REQUESTS_PER_SECOND = 2.0
+# failed downloads (404 of a deleted file, broken body) are given up after this many attempts
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 30
+THUMBNAIL_EXT = "s.jpg"
+
+
+def media_key(md5: str) -> str:
+    """
+    :param md5: "md5" field of post, base64 of MD5 digest of the file
+    :return: hex digest that names the file in media store, empty string if field is malformed
+    """
+    try:
+        digest = base64.b64decode(md5, validate=True)
+    except (binascii.Error, ValueError) as _:
+        return ""
+    return digest.hex() if len(digest) == 16 else ""
+
+
+def thumbnail_link(img_link: str) -> str:
+    """
+    :return: link of thumbnail, {tim}s.jpg next to {tim}{ext}
+    """
+    return f"{os.path.splitext(img_link)[0]}{THUMBNAIL_EXT}"
+
+
+def post_files(posts: list) -> list:
+    """
+    :param posts: parsed thread and/or replies, parsed with media metadata
+    :return: queue entries of attached files
+    """
+    return [dict(post["media"], link=post["img_link"]) for post in posts if post.get("media") and post.get("img_link")]
+
+
+class MediaStore:
+    """
+    Content-addressed files: a file is kept once as {directory}/{key[:2]}/{key}{ext}, key is hex MD5 of the full file,
+    so a picture reposted in thousands of threads takes one download and one file. Thumbnails are kept under the key
+    of their full file with s.jpg extension.
+    """
+
+    def __init__(self, directory: str = MEDIA_PATH):
+        self.directory = directory
+
+    def path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}{ext}")
+
+    def has(self, key: str, ext: str, size: int = 0) -> bool:
+        """
+        :param size: expected size of file, 0 if unknown
+        """
+        try:
+            stored = os.path.getsize(self.path(key, ext))
+        except OSError as _:
+            return False
+        return not size or stored == size
+
+    def write(self, key: str, ext: str, body: bytes) -> None:
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(body)
+        os.replace(tmp_path, path)
+
+
+class MediaQueue:
+    """
+    Durable download queue in SQLite. Files are queued by MD5, so a file attached to many posts is queued once, and
+    keep their completion flag and attempts between runs, an interrupted run resumes with the files that weren't
+    downloaded.
+    """
+
+    def __init__(self, path: str = MEDIA_QUEUE_PATH, max_attempts: int = MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS media ("
+                "md5 TEXT PRIMARY KEY, link TEXT NOT NULL, fsize INTEGER NOT NULL, w INTEGER NOT NULL, "
+                "h INTEGER NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0)"
+            )
+
+    @classmethod
+    def from_config(cls, config: dict) -> "MediaQueue":
+        return cls(config.get("media_queue_path", MEDIA_QUEUE_PATH))
+
+    def enqueue(self, files: list) -> None:
+        """
+        :param files: entries with md5/fsize/w/h/link, files already queued are ignored
+        """
+        if not files:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO media (md5, link, fsize, w, h) VALUES (?, ?, ?, ?, ?)",
+                ((file["md5"], file["link"], file["fsize"], file["w"], file["h"]) for file in files)
+            )
+
+    def pending(self, limit: int) -> list:
+        """
+        :return: up to `limit` files that aren't downloaded and weren't given up, in order of queueing
+        """
+        return [{"md5": md5, "link": link, "fsize": fsize} for md5, link, fsize in self.connection.execute(
+            "SELECT md5, link, fsize FROM media WHERE done = 0 AND attempts < ? ORDER BY rowid LIMIT ?",
+            (self.max_attempts, limit)
+        )]
+
+    def complete(self, md5: str) -> None:
+        with self.connection:
+            self.connection.execute("UPDATE media SET done = 1 WHERE md5 = ?", (md5,))
+
+    def fail(self, md5: str) -> None:
+        with self.connection:
+            self.connection.execute("UPDATE media SET attempts = attempts + 1 WHERE md5 = ?", (md5,))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class MediaStorage(StorageWrapper):
+    """
+    Storage that queues files attached to every saved thread and appended reply for download, storage is written first
+    """
+
+    def __init__(self, storage: ThreadStorage, queue: MediaQueue):
+        super().__init__(storage)
+        self.queue = queue
+
+    async def create(self, no: int, context: dict) -> None:
+        await super().create(no, context)
+        self.queue.enqueue(post_files([context] + context.get("replies", [])))
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        written = await super().append(no, replies, compact)
+        self.queue.enqueue(post_files(written))
+        return written
+
+    def close(self) -> None:
+        super().close()
+        self.queue.close()
+
+
+class MediaDownloader:
+    """
+    Downloads queued files into media store, separately from text scraping: it has its own connections, its own rate
+    limiter and at most `concurrency` downloads in flight. Files that are already in the store (same MD5 and size) are
+    not downloaded again. A full file is saved only if its MD5 and size match the ones API gave, with `thumbnails`
+    only {tim}s.jpg thumbnails are fetched.
+    """
+
+    def __init__(self, queue: MediaQueue, store: MediaStore, concurrency: int = MEDIA_CONCURRENCY,
+                 thumbnails: bool = False, rate_limiter: RateLimiter = None, poll_interval: float = POLL_INTERVAL):
+        self.queue = queue
+        self.store = store
+        self.concurrency = concurrency
+        self.thumbnails = thumbnails
+        self.rate_limiter = rate_limiter or RateLimiter(rate=MEDIA_REQUESTS_PER_SECOND)
+        self.poll_interval = poll_interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.downloaded = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> "MediaDownloader":
+        return cls(
+            queue=MediaQueue.from_config(config),
+            store=MediaStore(config.get("media_path", MEDIA_PATH)),
+            concurrency=config.get("media_concurrency", MEDIA_CONCURRENCY),
+            thumbnails=config.get("media_thumbnails", False),
+            rate_limiter=RateLimiter(rate=config.get("media_requests_per_second", MEDIA_REQUESTS_PER_SECOND)),
+            poll_interval=config.get("poll_interval", POLL_INTERVAL),
+        )
+
+    async def run(self, done: asyncio.Event = None) -> None:
+        """
+        Downloads queued files in batches of a few times `concurrency`
+        :param done: set when nothing more will be queued, downloader returns once the queue is empty after that.
+            Without it downloader waits for new files every `poll_interval` seconds until cancelled
+        """
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while True:
+                batch = self.queue.pending(self.concurrency * 4)
+                if batch:
+                    await asyncio.gather(*(self._download(session, file) for file in batch))
+                    continue
+                if done is None:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                if done.is_set():
+                    break
+                try:
+                    await asyncio.wait_for(done.wait(), self.poll_interval)
+                except asyncio.TimeoutError as _:
+                    pass
+        if self.downloaded or self.skipped:
+            log_message(f"MEDIA | DOWNLOADED | {self.downloaded} files | {self.skipped} already stored")
+
+    async def _download(self, session: aiohttp.ClientSession, file: dict) -> None:
+        key = media_key(file["md5"])
+        if not key:
+            log_error(f"Malformed md5 of {file['link']}")
+            self.queue.fail(file["md5"])
+            return
+        ext = THUMBNAIL_EXT if self.thumbnails else os.path.splitext(file["link"])[1]
+        if self.store.has(key, ext, 0 if self.thumbnails else file["fsize"]):
+            self.skipped += 1
+            self.queue.complete(file["md5"])
+            return
+        link = thumbnail_link(file["link"]) if self.thumbnails else file["link"]
+        async with self.semaphore:
+            await self.rate_limiter.acquire()
+            try:
+                async with session.get(link) as response:
+                    if response.status in THROTTLE_STATUSES:
+                        # not an attempt, the file is taken again with the next batch
+                        self.rate_limiter.on_throttle(parse_retry_after(response.headers.get("Retry-After")))
+                        return
+                    self.rate_limiter.on_success()
+                    if response.status != 200:
+                        log_error(f"Unable to download {link}, status {response.status}")
+                        self.queue.fail(file["md5"])
+                        return
+                    body = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as _:
+                log_error(f"Unable to download {link}")
+                self.queue.fail(file["md5"])
+                return
+        if not self.thumbnails and (len(body) != file["fsize"] or hashlib.md5(body).hexdigest() != key):
+            log_error(f"Downloaded {link} doesn't match its md5 and size")
+            self.queue.fail(file["md5"])
+            return
+        self.store.write(key, ext, body)
+        self.downloaded += 1
+        self.queue.complete(file["md5"])
+
+    def close(self) -> None:
+        self.queue.close()
@@ -0,0 +1,239 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+from aiohttp import web
+
+WINDOW = 1000
+# seconds, from a local replay up to a slow retry of the live API
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = "scraper_"
+METRICS_HOST = "127.0.0.1"
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple, extra: str = "") -> str:
+    """
+    :return: labels in Prometheus text format, e.g. {endpoint="thread",status="200"}
+    """
+    pairs = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _quantile(values: list, share: float) -> float:
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class Histogram:
+    """
+    Cumulative bucket counts for Prometheus and the last WINDOW observations for p50/p99 of the JSON summary
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS, window: int = WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def summary(self) -> dict:
+        recent = sorted(self.recent)
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": _quantile(recent, 0.5) if recent else 0,
+            "p99": _quantile(recent, 0.99) if recent else 0,
+            "max": recent[-1] if recent else 0
+        }
+
+
+class Metrics:
+    """
+    In-process registry of scraper metrics.
+    Windows (observe/summary/reset) keep the last WINDOW observations of a metric, counters, gauges and histograms
+    are labelled and live for the whole process, they are exported in Prometheus text format and as JSON summary.
+    """
+
+    def __init__(self, window: int = WINDOW):
+        self.window = window
+        self.values = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def observe(self, name: str, value: float) -> None:
+        if name not in self.values:
+            self.values[name] = deque(maxlen=self.window)
+        self.values[name].append(value)
+
+    def summary(self, name: str) -> dict:
+        """
+        :return: count, p50 and max of recent observations, empty dict if metric has none
+        """
+        values = sorted(self.values.get(name, ()))
+        if not values:
+            return {}
+        return {
+            "count": len(values),
+            "p50": values[len(values) // 2],
+            "max": values[-1]
+        }
+
+    def reset(self, name: str) -> None:
+        self.values.pop(name, None)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self.gauges[_key(name, labels)] = value
+
+    def add(self, name: str, value: float, **labels) -> None:
+        """
+        Moves gauge by value, e.g. -1 when a queued item is done
+        """
+        key = _key(name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def histogram(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels) -> None:
+        key = _key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets, self.window)
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observes seconds spent in the block in histogram `name`
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> dict:
+        """
+        :return: JSON summary of counters, gauges and histograms, label values are joined into the key
+            (e.g. "requests_total{endpoint=thread,status=200}")
+        """
+        def name_of(key: tuple) -> str:
+            name, labels = key
+            return name + ("{" + ",".join(f"{label}={value}" for label, value in labels) + "}" if labels else "")
+
+        return {
+            "started": self.started,
+            "seconds": round(time.time() - self.started, 3),
+            "counters": {name_of(key): value for key, value in sorted(self.counters.items())},
+            "gauges": {name_of(key): value for key, value in sorted(self.gauges.items())},
+            "histograms": {name_of(key): histogram.summary() for key, histogram in sorted(self.histograms.items())},
+        }
+
+    def dump(self, path: str) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.snapshot(), file, indent=2)
+        os.replace(tmp_path, path)
+
+    def prometheus(self) -> str:
+        """
+        :return: counters, gauges and histograms in Prometheus text exposition format
+        """
+        lines = []
+        for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+            typed = set()
+            for (name, labels), value in sorted(series.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                    typed.add(name)
+                lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+        typed = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _labels(labels, f'le="{le}"')
+                lines.append(f"{PREFIX}{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint that serves metrics of the process in Prometheus text format at /metrics
+    """
+
+    def __init__(self, registry: Metrics, port: int, host: str = METRICS_HOST):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def handle(self, _: web.Request) -> web.Response:
+        return web.Response(body=self.registry.prometheus().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+metrics = Metrics()
+
+
+async def start_server(config: dict, worker: int = 0):
+    """
+    :param config: with `metrics_port` the endpoint is started, worker N listens on `metrics_port` + N
+    :return: started MetricsServer or None
+    """
+    if not config.get("metrics_port"):
+        return None
+    server = MetricsServer(metrics, config["metrics_port"] + worker, config.get("metrics_host", METRICS_HOST))
+    await server.start()
+    return server
+
+
+def summary_path(config: dict, worker: int = 0, workers: int = 1):
+    """
+    :return: path of JSON summary from `metrics_summary_path`, metrics.json becomes metrics.{worker}.json when there
+        are several workers, None if summary isn't configured
+    """
+    path = config.get("metrics_summary_path")
+    if not path or workers == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker}{ext}"
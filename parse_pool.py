@@ -0,0 +1,167 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from boards import DEFAULT_BOARD
+from metrics import metrics
+
+PARSE_WORKERS = 2
+BATCH_SIZE = 16
+# how long the first job of a batch waits for others before the batch is sent anyway
+BATCH_DELAY = 0.005
+# parsed posts remembered by post number, enough for every reply of a full catalog
+CACHE_SIZE = 50000
+
+
+def parse_batch(jobs: list, keep_refs: bool = False, keep_media: bool = False) -> list:
+    """
+    Runs in worker process
+    :param jobs: list of (kind, posts, board), kind is "context" for whole thread or "comments" for replies only
+    :param keep_refs: store numbers of quoted posts in every reply
+    :param keep_media: store md5/fsize/w/h of attached files
+    :return: parsed results in order of jobs
+    """
+    # imported here, because fixed_functions imports this module
+    from fixed_functions import get_context, get_comments
+    return [get_context(posts, keep_refs, board, keep_media) if kind == "context"
+            else get_comments(posts, keep_refs, board, keep_media)
+            for kind, posts, board in jobs]
+
+
+class ParsePool:
+    """
+    Parse stage of the scraper: raw posts payloads are cleaned and normalised in a pool of worker processes, so HTML
+    cleaning doesn't block network I/O on the event loop. Jobs are sent in batches of up to `batch_size` payloads.
+    With 0 workers payloads are parsed inline.
+    Parsed replies are memoised by post number (posts can't be edited), so a refetched thread sends only posts that
+    weren't parsed before to the workers.
+    """
+
+    def __init__(self, workers: int = PARSE_WORKERS, batch_size: int = BATCH_SIZE, batch_delay: float = BATCH_DELAY,
+                 keep_refs: bool = False, cache_size: int = CACHE_SIZE, keep_media: bool = False):
+        self.workers = workers
+        self.keep_refs = keep_refs
+        self.keep_media = keep_media
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+        self.batch = []
+        self.flush_handle = None
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ParsePool":
+        return cls(
+            workers=config.get("parse_workers", PARSE_WORKERS),
+            batch_size=config.get("parse_batch_size", BATCH_SIZE),
+            keep_refs=config.get("keep_refs", False),
+            cache_size=config.get("parse_cache_size", CACHE_SIZE),
+            keep_media=config.get("download_media", False),
+        )
+
+    async def __aenter__(self) -> "ParsePool":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.close()
+
+    async def parse_thread(self, posts: list, board: str = DEFAULT_BOARD) -> dict:
+        """
+        :param posts: posts of thread from API
+        :param board: board of thread
+        :return: thread in title/text/date/img_link/replies shape
+        """
+        cached, missing = self._lookup(posts[1:], board)
+        with metrics.timer("parse_seconds", kind="context"):
+            context = await self._submit("context", posts[:1] + missing, board)
+        if "replies" in posts[0]:
+            context["replies"] = self._merge(posts[1:], board, cached, context["replies"])
+        return context
+
+    async def parse_comments(self, posts: list, board: str = DEFAULT_BOARD) -> list:
+        """
+        :param posts: replies from API
+        :param board: board of replies
+        :return: parsed replies
+        """
+        cached, missing = self._lookup(posts, board)
+        with metrics.timer("parse_seconds", kind="comments"):
+            parsed = await self._submit("comments", missing, board) if missing else []
+        return self._merge(posts, board, cached, parsed)
+
+    def _lookup(self, posts: list, board: str) -> tuple:
+        """
+        :return: already parsed replies by post number and posts that have to be parsed
+        """
+        cached, missing = {}, []
+        for post in posts:
+            # post numbers are unique only within a board
+            key = (board, post["no"])
+            comment = self.cache.get(key)
+            if comment is None:
+                missing.append(post)
+            else:
+                cached[post["no"]] = comment
+                self.cache.move_to_end(key)
+        metrics.inc("parse_cache_hits_total", len(cached))
+        metrics.inc("parsed_posts_total", len(missing))
+        return cached, missing
+
+    def _merge(self, posts: list, board: str, cached: dict, parsed: list) -> list:
+        """
+        :param posts: replies from API
+        :param cached: replies found in cache before parsing
+        :param parsed: freshly parsed replies, they are remembered
+        :return: parsed replies in order of posts
+        """
+        for comment in parsed:
+            cached[comment["no"]] = comment
+            self.cache[(board, comment["no"])] = comment
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return [cached[post["no"]] for post in posts]
+
+    async def _submit(self, kind: str, posts: list, board: str):
+        if self.executor is None:
+            return parse_batch([(kind, posts, board)], self.keep_refs, self.keep_media)[0]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.batch.append((kind, posts, board, future))
+        metrics.set("parse_queue_depth", len(self.batch))
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_delay, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        metrics.set("parse_queue_depth", 0)
+        loop = asyncio.get_running_loop()
+        done = loop.run_in_executor(self.executor, parse_batch,
+                                    [(kind, posts, board) for kind, posts, board, _ in batch], self.keep_refs,
+                                    self.keep_media)
+        done.add_done_callback(lambda result: self._resolve(batch, result))
+
+    @staticmethod
+    def _resolve(batch: list, result: asyncio.Future) -> None:
+        for i, (_, _, _, future) in enumerate(batch):
+            if future.done():
+                continue
+            if result.cancelled():
+                future.cancel()
+            elif result.exception() is not None:
+                future.set_exception(result.exception())
+            else:
+                future.set_result(result.result()[i])
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
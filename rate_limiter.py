@@ -0,0 +1,184 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+REQUESTS_PER_SECOND = 1.0
+BURST = 4
+MIN_REQUESTS_PER_SECOND = 0.2
+MAX_REQUESTS_PER_SECOND = 8.0
+INCREASE_STEP = 0.05
+DECREASE_FACTOR = 0.5
+# throttled responses that arrive within this window after a cut belong to the same congestion event
+DECREASE_COOLDOWN = 1.0
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}
+LEASE_PATH = "rate_lease.sqlite3"
+LEASE_TTL = 10.0
+
+
+def parse_retry_after(value: str) -> float:
+    """
+    :param value: value of Retry-After header, either seconds or HTTP date
+    :return: seconds to wait, 0 if header is empty or malformed
+    """
+    if not value:
+        return 0
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        until = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return max((until - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class RateLease:
+    """
+    Global request budget shared by scraper processes through SQLite file.
+    Every process holds a lease that it renews every `ttl / 2` seconds, processes whose lease expired (stopped or
+    crashed) are not counted, and the budget is split evenly between live ones. Pause asked by server (Retry-After)
+    is shared too, so a throttled process holds back the others.
+    """
+
+    def __init__(self, budget: float, path: str = LEASE_PATH, ttl: float = LEASE_TTL, holder: str = None):
+        self.budget = budget
+        self.ttl = ttl
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self.renewed_at = float("-inf")
+        self.connection = sqlite3.connect(path, timeout=ttl)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases (holder TEXT PRIMARY KEY, expires REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS pause (id INTEGER PRIMARY KEY CHECK (id = 0), until REAL NOT NULL)"
+            )
+
+    def due(self) -> bool:
+        return time.monotonic() - self.renewed_at >= self.ttl / 2
+
+    def renew(self) -> tuple:
+        """
+        :return: share of budget of this process (requests per second) and time (time.time()) until which all
+            processes are paused
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO leases (holder, expires) VALUES (?, ?)",
+                                    (self.holder, now + self.ttl))
+            self.connection.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            live, = self.connection.execute("SELECT COUNT(*) FROM leases").fetchone()
+            row = self.connection.execute("SELECT until FROM pause WHERE id = 0").fetchone()
+        self.renewed_at = time.monotonic()
+        return self.budget / max(live, 1), row[0] if row else 0.0
+
+    def pause(self, until: float) -> None:
+        """
+        :param until: time.time() until which no process sends requests
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO pause (id, until) VALUES (0, ?) ON CONFLICT(id) DO UPDATE SET until = MAX(until, ?)",
+                (until, until)
+            )
+
+    def release(self) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM leases WHERE holder = ?", (self.holder,))
+        self.connection.close()
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request of the run.
+    Tokens are refilled at `rate` per second up to `burst`. The rate grows additively after each successful response
+    and is cut multiplicatively on 429/5xx (AIMD), Retry-After pauses the whole bucket.
+    With a lease the rate never goes over this process' share of the global budget.
+    """
+
+    def __init__(self, rate: float = REQUESTS_PER_SECOND, burst: int = BURST,
+                 min_rate: float = MIN_REQUESTS_PER_SECOND, max_rate: float = MAX_REQUESTS_PER_SECOND,
+                 increase_step: float = INCREASE_STEP, decrease_factor: float = DECREASE_FACTOR,
+                 lease: RateLease = None):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, rate)
+        self.local_max_rate = self.max_rate
+        self.lease = lease
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased_at = float("-inf")
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RateLimiter":
+        return cls(
+            rate=config.get("requests_per_second", REQUESTS_PER_SECOND),
+            burst=config.get("burst", BURST),
+            min_rate=config.get("min_requests_per_second", MIN_REQUESTS_PER_SECOND),
+            max_rate=config.get("max_requests_per_second", MAX_REQUESTS_PER_SECOND),
+            lease=RateLease(config["global_requests_per_second"], config.get("rate_lease_path", LEASE_PATH))
+            if config.get("global_requests_per_second") else None,
+        )
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _renew_lease(self) -> None:
+        share, paused_until = self.lease.renew()
+        self.max_rate = min(self.local_max_rate, share)
+        self.rate = min(self.rate, self.max_rate)
+        # lease keeps wall clock time, bucket keeps monotonic time
+        self.paused_until = max(self.paused_until, time.monotonic() + paused_until - time.time())
+
+    async def acquire(self) -> None:
+        """
+        Waits until a token is available and takes it, waiters are served in arrival order
+        """
+        async with self._lock:
+            while True:
+                if self.lease is not None and self.lease.due():
+                    self._renew_lease()
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after: float = 0) -> None:
+        """
+        :param retry_after: seconds the server asked to wait before next request
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if now - self.decreased_at >= DECREASE_COOLDOWN:
+            self.rate = min(max(self.min_rate, self.rate * self.decrease_factor), self.max_rate)
+            self.decreased_at = now
+        self.tokens = 0
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+            if self.lease is not None:
+                self.lease.pause(time.time() + retry_after)
+
+    def close(self) -> None:
+        if self.lease is not None:
+            self.lease.release()
+            self.lease = None
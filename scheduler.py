@@ -0,0 +1,100 @@
+import time
+
+REFRESH_BUDGET = 100
+MIN_REFRESH_INTERVAL = 30
+MAX_REFRESH_INTERVAL = 1800
+# refresh a thread roughly every time it is expected to get this many new posts
+POSTS_PER_REFRESH = 5
+# weight of the newest observation in post velocity average
+VELOCITY_SMOOTHING = 0.5
+
+
+class RefreshScheduler:
+    """
+    Decides which changed catalog threads are fetched and in which order.
+    Every threads.json observation updates post velocity (replies per hour, exponentially smoothed) and page position
+    of each thread. Hot threads (fast, close to the first page) are fetched first and become due again sooner, cold
+    threads are deferred up to `max_interval` seconds since their last fetch. New threads are always fetched, of the
+    changed ones at most `budget` are fetched per catalog check, the rest stay changed in the manifest and are picked
+    up by the next check. Velocities are kept in memory only, so the scheduler is used by the daemon that sees every
+    poll, one-shot runs start without history and fetch every changed thread.
+    """
+
+    def __init__(self, budget: int = REFRESH_BUDGET, min_interval: float = MIN_REFRESH_INTERVAL,
+                 max_interval: float = MAX_REFRESH_INTERVAL):
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.threads = {}
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RefreshScheduler":
+        return cls(
+            budget=config.get("refresh_budget", REFRESH_BUDGET),
+            min_interval=config.get("poll_interval", MIN_REFRESH_INTERVAL),
+            max_interval=config.get("max_refresh_interval", MAX_REFRESH_INTERVAL),
+        )
+
+    def observe(self, pages: list, now: float = None) -> None:
+        """
+        :param pages: threads.json content, threads missing from it are forgotten
+        :param now: time of observation
+        """
+        now = now or time.time()
+        alive = set()
+        for page in pages:
+            for thread in page["threads"]:
+                no = thread["no"]
+                alive.add(no)
+                replies = thread.get("replies", 0)
+                state = self.threads.get(no)
+                if state is None:
+                    self.threads[no] = {
+                        "replies": replies,
+                        "seen_at": now,
+                        "velocity": 0.0,
+                        "page": page.get("page", 1),
+                        "fetched_at": 0.0
+                    }
+                    continue
+                hours = (now - state["seen_at"]) / 3600
+                if hours > 0:
+                    velocity = max(replies - state["replies"], 0) / hours
+                    state["velocity"] += VELOCITY_SMOOTHING * (velocity - state["velocity"])
+                state["replies"] = replies
+                state["seen_at"] = now
+                state["page"] = page.get("page", 1)
+        for no in list(self.threads):
+            if no not in alive:
+                del self.threads[no]
+
+    def score(self, no: int) -> float:
+        state = self.threads.get(no)
+        if state is None:
+            return 0.0
+        return (state["velocity"] + 1) / max(state["page"], 1)
+
+    def refresh_interval(self, no: int) -> float:
+        velocity = self.threads.get(no, {}).get("velocity", 0.0)
+        if velocity <= 0:
+            return self.max_interval
+        return min(max(3600 * POSTS_PER_REFRESH / velocity, self.min_interval), self.max_interval)
+
+    def plan(self, new: list, changed: list, now: float = None) -> list:
+        """
+        :param new: threads that aren't stored yet, they are never deferred
+        :param changed: stored threads with new activity
+        :param now: planning time
+        :return: threads to fetch, every new one and at most `budget` due changed ones, hottest first
+        """
+        now = now or time.time()
+        due = sorted((no for no in changed
+                      if now - self.threads.get(no, {}).get("fetched_at", 0.0) >= self.refresh_interval(no)),
+                     key=self.score, reverse=True)
+        if self.budget:
+            due = due[:self.budget]
+        planned = sorted(new, key=self.score, reverse=True) + due
+        for no in planned:
+            if no in self.threads:
+                self.threads[no]["fetched_at"] = now
+        return planned
@@ -0,0 +1,302 @@
+import argparse
+import json
+import re
+import sqlite3
+import time
+from datetime import datetime
+
+from logger import log_error, log_message
+from metrics import metrics
+from storage import StorageWrapper, ThreadStorage
+
+INDEX_PATH = "index.sqlite3"
+# words longer than this are links, hashes and the like, nobody searches for them
+MAX_TERM_LENGTH = 32
+# ids of terms kept in memory, the cache is dropped once it grows over this
+MAX_CACHED_TERMS = 1000000
+# SQLite limit of variables in one statement is 999 in older versions
+SELECT_CHUNK = 500
+REBUILD_FLUSH_EVERY = 1000
+DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+WORD = re.compile(r"\w+")
+
+
+def terms_of(text: str) -> set:
+    """
+    :return: distinct lowercase words of text, "$BTC" and "btc" are the same term
+    """
+    return {word for word in WORD.findall(text.lower()) if len(word) <= MAX_TERM_LENGTH}
+
+
+def post_time(date: str) -> int:
+    """
+    :param date: "date" of stored post (see get_date)
+    :return: unix time of post, 0 if date can't be parsed
+    """
+    try:
+        return int(time.mktime(time.strptime(date, DATE_FORMAT)))
+    except (TypeError, ValueError) as _:
+        return 0
+
+
+def parse_time(value: str) -> int:
+    """
+    :param value: unix time or ISO date ("2024-10-17", "2024-10-17T09:30")
+    """
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+class SearchIndex:
+    """
+    Inverted index of stored posts in SQLite: term -> postings (time, post, thread).
+    Postings are clustered by term and time, so lookup of a term in a time range reads only its postings in the
+    range instead of scanning stored threads. Posts are indexed as threads are saved or extended, postings are
+    buffered and written by flush() together with the manifest. Indexing is idempotent, a post indexed twice keeps
+    one posting per term, so the index can be rebuilt from storage at any time.
+    """
+
+    def __init__(self, path: str = INDEX_PATH):
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS postings ("
+                "term INTEGER NOT NULL, time INTEGER NOT NULL, post INTEGER NOT NULL, thread INTEGER NOT NULL, "
+                "PRIMARY KEY (term, time, post)) WITHOUT ROWID"
+            )
+        self.term_ids = {}
+        self.pending = []
+
+    @classmethod
+    def from_config(cls, config: dict) -> "SearchIndex":
+        return cls(config.get("index_path", INDEX_PATH))
+
+    def add_thread(self, no: int, context: dict) -> None:
+        """
+        :param context: thread in title/text/date/img_link/replies shape, OP is post `no`
+        """
+        postings = self._postings(no, no, post_time(context.get("date")),
+                                  f"{context.get('title', '')} {context.get('text', '')}")
+        self.pending.extend(postings + self._reply_postings(no, context.get("replies", [])))
+
+    def add_replies(self, no: int, replies: list) -> None:
+        self.pending.extend(self._reply_postings(no, replies))
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        if len(self.term_ids) > MAX_CACHED_TERMS:
+            self.term_ids = {}
+        with self.connection:
+            self._resolve({term for term, *_ in self.pending if term not in self.term_ids})
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO postings (term, time, post, thread) VALUES (?, ?, ?, ?)",
+                ((self.term_ids[term], posted, post, thread) for term, posted, post, thread in self.pending)
+            )
+        metrics.inc("index_postings_total", len(self.pending))
+        self.pending = []
+
+    def search(self, terms: list, since: int = None, until: int = None, limit: int = None) -> list:
+        """
+        :param terms: every term must be in the post
+        :param since: unix time, posts from it on
+        :param until: unix time, posts before it
+        :param limit: amount of newest posts returned
+        :return: {"thread", "post", "time"} of matching posts, newest first
+        """
+        ids = self._ids(terms)
+        if ids is None:
+            return []
+        query, args = self._query("thread, post, time", ids, since, until)
+        query += " ORDER BY time DESC, post DESC"
+        if limit:
+            query += " LIMIT ?"
+            args.append(limit)
+        return [{"thread": thread, "post": post, "time": posted}
+                for thread, post, posted in self.connection.execute(query, args)]
+
+    def count(self, terms: list, since: int = None, until: int = None, bucket: int = 0) -> dict:
+        """
+        :param bucket: seconds, with 0 the total is returned
+        :return: amount of matching posts by start of time bucket (e.g. mentions of a ticker per hour), {0: total}
+            without bucket
+        """
+        ids = self._ids(terms)
+        if ids is None:
+            return {}
+        query, args = self._query("time", ids, since, until)
+        if not bucket:
+            return {0: self.connection.execute(f"SELECT COUNT(*) FROM ({query})", args).fetchone()[0]}
+        return dict(self.connection.execute(
+            f"SELECT time / ? * ? AS start, COUNT(*) FROM ({query}) GROUP BY start ORDER BY start",
+            [bucket, bucket] + args
+        ))
+
+    def rebuild(self, storage: ThreadStorage) -> int:
+        """
+        Drops the index and indexes every thread of storage again
+        :return: amount of indexed threads
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM postings")
+            self.connection.execute("DELETE FROM terms")
+        self.term_ids = {}
+        self.pending = []
+        indexed = 0
+        for no in storage.threads():
+            try:
+                self.add_thread(no, storage.read(no))
+            except (KeyError, ValueError) as _:
+                log_error(f"Unable to index thread {no}")
+                continue
+            indexed += 1
+            if indexed % REBUILD_FLUSH_EVERY == 0:
+                self.flush()
+                log_message(f"INDEX | REBUILDING | {indexed} threads")
+        self.flush()
+        return indexed
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+    def _reply_postings(self, thread: int, replies: list) -> list:
+        """
+        Replies saved by previous versions have no "no", they can't be told apart as posts and are left out
+        """
+        postings = []
+        for reply in replies:
+            if reply.get("no") is None:
+                continue
+            postings.extend(self._postings(thread, reply["no"], post_time(reply.get("date")), reply.get("text", "")))
+        return postings
+
+    @staticmethod
+    def _postings(thread: int, post: int, posted: int, text: str) -> list:
+        return [(term, posted, post, thread) for term in terms_of(text)]
+
+    def _resolve(self, terms: set) -> None:
+        """
+        Loads ids of terms into the cache, terms that aren't in the index yet are added
+        """
+        if not terms:
+            return
+        self.connection.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)", ((term,) for term in terms))
+        self.term_ids.update(self._select_ids(list(terms)))
+
+    def _select_ids(self, terms: list) -> dict:
+        ids = {}
+        for i in range(0, len(terms), SELECT_CHUNK):
+            chunk = terms[i:i + SELECT_CHUNK]
+            ids.update(self.connection.execute(
+                f"SELECT term, id FROM terms WHERE term IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        return ids
+
+    def _ids(self, terms: list):
+        """
+        :return: ids of distinct query terms, None if some term isn't in the index
+        """
+        wanted = set()
+        for term in terms:
+            wanted |= terms_of(term)
+        ids = self._select_ids(list(wanted))
+        if not wanted or len(ids) < len(wanted):
+            return None
+        return list(ids.values())
+
+    @staticmethod
+    def _query(columns: str, ids: list, since: int, until: int) -> tuple:
+        """
+        :return: query of postings of posts that have every term and its arguments
+        """
+        conditions = [f"term IN ({','.join('?' * len(ids))})"]
+        args = list(ids)
+        if since is not None:
+            conditions.append("time >= ?")
+            args.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            args.append(until)
+        where = " AND ".join(conditions)
+        if len(ids) == 1:
+            return f"SELECT {columns} FROM postings WHERE {where}", args
+        return (f"SELECT {columns} FROM postings WHERE {where} GROUP BY post "
+                f"HAVING COUNT(*) = {len(ids)}"), args
+
+
+class IndexStorage(StorageWrapper):
+    """
+    Storage that adds every saved thread and appended reply to the search index, storage is written first
+    """
+
+    def __init__(self, storage: ThreadStorage, index: SearchIndex):
+        super().__init__(storage)
+        self.index = index
+
+    async def create(self, no: int, context: dict) -> None:
+        await super().create(no, context)
+        self.index.add_thread(no, context)
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        written = await super().append(no, replies, compact)
+        self.index.add_replies(no, written)
+        return written
+
+    def flush(self) -> None:
+        super().flush()
+        self.index.flush()
+
+    def close(self) -> None:
+        super().close()
+        self.index.close()
+
+
+if __name__ == "__main__":
+    # python search_index.py search <index_path> TERM [TERM ...] [--since DATE] [--until DATE] [--limit N]
+    # python search_index.py count <index_path> TERM [TERM ...] [--since DATE] [--until DATE] [--bucket SECONDS]
+    # python search_index.py rebuild <index_path> <folder_path> [<backend> <storage_path>]
+    parser = argparse.ArgumentParser(description="Search stored posts by terms and time")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("search", "count"):
+        command = commands.add_parser(name)
+        command.add_argument("index_path")
+        command.add_argument("terms", nargs="+")
+        command.add_argument("--since", help="unix time or ISO date")
+        command.add_argument("--until", help="unix time or ISO date")
+        if name == "search":
+            command.add_argument("--limit", type=int, help="newest posts only")
+        else:
+            command.add_argument("--bucket", type=int, default=0, help="count per this many seconds")
+    command = commands.add_parser("rebuild")
+    command.add_argument("index_path")
+    command.add_argument("folder_path")
+    command.add_argument("backend", nargs="?", default="files", choices=("files", "sqlite", "segments", "compressed"))
+    command.add_argument("storage_path", nargs="?")
+    args = parser.parse_args()
+
+    search_index = SearchIndex(args.index_path)
+    try:
+        if args.command == "rebuild":
+            from storage import open_storage
+            storage_config = {"folder_path": args.folder_path, "storage_backend": args.backend}
+            if args.storage_path:
+                storage_config["storage_path"] = args.storage_path
+            source = open_storage(storage_config)
+            try:
+                log_message(f"INDEX | REBUILT | {search_index.rebuild(source)} threads")
+            finally:
+                source.close()
+        elif args.command == "search":
+            for found in search_index.search(args.terms, args.since and parse_time(args.since),
+                                             args.until and parse_time(args.until), args.limit):
+                print(json.dumps(found))
+        else:
+            for start, amount in search_index.count(args.terms, args.since and parse_time(args.since),
+                                                    args.until and parse_time(args.until), args.bucket).items():
+                print(f"{start}\t{amount}" if args.bucket else amount)
+    finally:
+        search_index.close()
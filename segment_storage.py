@@ -0,0 +1,170 @@
+import os
+import struct
+import time
+import zlib
+
+from logger import log_error
+from metrics import metrics
+from storage import ThreadStorage, last_reply_no, replies_after
+from streaming_json import dumps, loads
+
+SEGMENTS_PATH = "segments"
+SEGMENT_SIZE = 64 * 1024 * 1024
+# thread is folded into one record once it has this many appended records
+COMPACT_AFTER_RECORDS = 32
+COMPRESSION_LEVEL = 6
+# record header: length of compressed body, thread no, kind of record, timestamp of write
+HEADER = struct.Struct(">IQBI")
+CREATE = 0
+APPEND = 1
+
+
+class SegmentStorage(ThreadStorage):
+    """
+    Compressed append-only segments.
+    Every write is one record appended to the current segment file ({id:08d}.seg), a segment is closed once it
+    grows over `segment_size`. CREATE record holds whole thread, APPEND record holds new replies, bodies are JSON
+    compressed with zlib. Location of records of every thread since its last CREATE is indexed in memory, the index is
+    rebuilt from record headers on open, so bodies are never read to find a thread. compact_all() rewrites live
+    threads into new segments and drops old ones.
+    """
+
+    def __init__(self, directory: str = SEGMENTS_PATH, segment_size: int = SEGMENT_SIZE,
+                 compact_after: int = COMPACT_AFTER_RECORDS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compact_after = compact_after
+        os.makedirs(directory, exist_ok=True)
+        # thread no -> list of (segment id, offset of body, length of body)
+        self.index = {}
+        # thread no -> no of its last stored reply, threads written before open are read when it's first needed
+        self.last_no = {}
+        self.modified_at = {}
+        self.segment_id = 0
+        for segment_id in self._segments():
+            self._scan(segment_id)
+            self.segment_id = segment_id
+        self.file = open(self._segment_path(self.segment_id), "ab")
+
+    async def create(self, no: int, context: dict) -> None:
+        self.index[no] = [self._write(no, CREATE, context)]
+        self.last_no[no] = last_reply_no(context.get("replies", []))
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        if no not in self.index:
+            raise KeyError(no)
+        replies = replies_after(replies, self._last_no(no))
+        if replies:
+            self.index[no].append(self._write(no, APPEND, replies))
+            self.last_no[no] = last_reply_no(replies) or self.last_no[no]
+        if compact or len(self.index[no]) > self.compact_after:
+            self.compact(no)
+        return replies
+
+    def read(self, no: int) -> dict:
+        thread = None
+        for location in self.index[no]:
+            body = self._read(location)
+            if thread is None:
+                thread = body
+            else:
+                thread["replies"].extend(body)
+        return thread
+
+    def compact(self, no: int) -> None:
+        if len(self.index.get(no, ())) > 1:
+            self.index[no] = [self._write(no, CREATE, self.read(no))]
+
+    def compact_all(self) -> int:
+        """
+        Writes every thread as one record into new segments, old segments with outdated records are removed
+        :return: amount of threads that had appended records
+        """
+        old_segments = self._segments()
+        self._rotate()
+        compacted = 0
+        for no in list(self.index):
+            compacted += len(self.index[no]) > 1
+            self.index[no] = [self._write(no, CREATE, self.read(no), self.modified_at[no])]
+        self.file.flush()
+        # new records are written before old segments are removed, so a crash leaves both and the newest wins
+        for segment_id in old_segments:
+            os.remove(self._segment_path(segment_id))
+        return compacted
+
+    def threads(self) -> list:
+        return list(self.index)
+
+    def modified(self, no: int) -> int:
+        return self.modified_at[no]
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def _last_no(self, no: int) -> int:
+        if no not in self.last_no:
+            self.last_no[no] = last_reply_no(self.read(no)["replies"])
+        return self.last_no[no]
+
+    def _read(self, location: tuple):
+        """
+        :return: decoded body of record
+        """
+        segment_id, offset, length = location
+        self.file.flush()
+        with open(self._segment_path(segment_id), "rb") as file:
+            file.seek(offset)
+            return loads(zlib.decompress(file.read(length)))
+
+    def _segments(self) -> list:
+        return sorted(int(name[:-len(".seg")]) for name in os.listdir(self.directory) if name.endswith(".seg"))
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"{segment_id:08d}.seg")
+
+    def _scan(self, segment_id: int) -> None:
+        """
+        Adds records of segment to index, record cut by crash at the end of segment is dropped
+        """
+        path = self._segment_path(segment_id)
+        size = os.path.getsize(path)
+        with open(path, "rb") as file:
+            offset = 0
+            while offset + HEADER.size <= size:
+                length, no, kind, modified = HEADER.unpack(file.read(HEADER.size))
+                if offset + HEADER.size + length > size:
+                    break
+                location = (segment_id, offset + HEADER.size, length)
+                if kind == CREATE:
+                    self.index[no] = [location]
+                elif no in self.index:
+                    self.index[no].append(location)
+                self.modified_at[no] = modified
+                offset += HEADER.size + length
+                file.seek(offset)
+        if offset < size:
+            log_error(f"Dropping broken record at the end of {path}")
+            with open(path, "r+b") as file:
+                file.truncate(offset)
+
+    def _rotate(self) -> None:
+        self.file.close()
+        self.segment_id += 1
+        self.file = open(self._segment_path(self.segment_id), "ab")
+
+    def _write(self, no: int, kind: int, data, modified: int = None) -> tuple:
+        """
+        :return: location of record body
+        """
+        if self.file.tell() >= self.segment_size:
+            self._rotate()
+        body = zlib.compress(dumps(data).encode(), COMPRESSION_LEVEL)
+        modified = modified or int(time.time())
+        offset = self.file.tell()
+        self.file.write(HEADER.pack(len(body), no, kind, modified) + body)
+        metrics.inc("storage_bytes_written_total", HEADER.size + len(body), backend="segments")
+        self.modified_at[no] = modified
+        return self.segment_id, offset + HEADER.size, len(body)
@@ -0,0 +1,26 @@
+from bisect import bisect
+from hashlib import md5
+
+REPLICAS = 64
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes. Every node is placed on the ring `replicas` times, key belongs to the first
+    node after its hash. When a node is added or removed only keys of that node move, so resizing the worker pool
+    doesn't reshuffle boards and threads that stay where they were.
+    """
+
+    def __init__(self, nodes: list, replicas: int = REPLICAS):
+        self.points = sorted((_hash(f"{node}:{replica}"), node) for node in nodes for replica in range(replicas))
+        self.hashes = [point for point, _ in self.points]
+
+    def node_for(self, key: str):
+        """
+        :return: node that owns key
+        """
+        return self.points[bisect(self.hashes, _hash(key)) % len(self.points)][1]
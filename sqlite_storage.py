@@ -0,0 +1,115 @@
+import sqlite3
+import time
+
+from metrics import metrics
+from storage import ThreadStorage, replies_after
+from streaming_json import dumps, loads
+
+STORAGE_PATH = "threads.sqlite3"
+FLUSH_EVERY = 100
+
+
+class SQLiteStorage(ThreadStorage):
+    """
+    All threads in one SQLite database in WAL mode.
+    `threads` keeps thread without replies, `replies` keeps one row per reply in order of arrival, so an update
+    inserts only new rows. Writes are collected in one transaction that is committed every `flush_every` operations
+    and by flush(), readers in other processes (e.g. sentiment jobs) see the last committed state without blocking
+    the scraper.
+    """
+
+    def __init__(self, path: str = STORAGE_PATH, flush_every: int = FLUSH_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL a commit doesn't wait for fsync, database stays consistent after a crash
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS threads ("
+                "no INTEGER PRIMARY KEY, "
+                "thread TEXT NOT NULL, "
+                "modified INTEGER NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS replies ("
+                "thread INTEGER NOT NULL, "
+                "position INTEGER NOT NULL, "
+                "reply TEXT NOT NULL, "
+                "PRIMARY KEY (thread, position)) WITHOUT ROWID"
+            )
+
+    async def create(self, no: int, context: dict) -> None:
+        thread = dumps({key: value for key, value in context.items() if key != "replies"})
+        self.connection.execute("INSERT OR REPLACE INTO threads (no, thread, modified) VALUES (?, ?, ?)",
+                                (no, thread, int(time.time())))
+        metrics.inc("storage_bytes_written_total", len(thread.encode()), backend="sqlite")
+        self.connection.execute("DELETE FROM replies WHERE thread = ?", (no,))
+        self._insert_replies(no, context.get("replies", []), 0)
+        self._written()
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        # replies are rows already, there is nothing to compact
+        row = self.connection.execute("SELECT position, reply FROM replies WHERE thread = ? ORDER BY position DESC "
+                                      "LIMIT 1", (no,)).fetchone()
+        position, last_no = (row[0] + 1, loads(row[1]).get("no") or 0) if row is not None else (0, 0)
+        replies = replies_after(replies, last_no)
+        self._insert_replies(no, replies, position)
+        self.connection.execute("UPDATE threads SET modified = ? WHERE no = ?", (int(time.time()), no))
+        self._written()
+        return replies
+
+    def read(self, no: int) -> dict:
+        row = self.connection.execute("SELECT thread FROM threads WHERE no = ?", (no,)).fetchone()
+        if row is None:
+            raise KeyError(no)
+        thread = loads(row[0])
+        thread["replies"] = [loads(reply) for reply, in self.connection.execute(
+            "SELECT reply FROM replies WHERE thread = ? ORDER BY position", (no,))]
+        return thread
+
+    def read_header(self, no: int) -> dict:
+        row = self.connection.execute("SELECT thread FROM threads WHERE no = ?", (no,)).fetchone()
+        if row is None:
+            raise KeyError(no)
+        return loads(row[0])
+
+    def compact(self, no: int) -> None:
+        pass
+
+    def compact_all(self) -> int:
+        """
+        Moves WAL content into the database file, threads don't need compaction
+        """
+        self.flush()
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return 0
+
+    def threads(self) -> list:
+        return [no for no, in self.connection.execute("SELECT no FROM threads")]
+
+    def modified(self, no: int) -> int:
+        row = self.connection.execute("SELECT modified FROM threads WHERE no = ?", (no,)).fetchone()
+        if row is None:
+            raise KeyError(no)
+        return row[0]
+
+    def flush(self) -> None:
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+    def _insert_replies(self, no: int, replies: list, position: int) -> None:
+        rows = [(no, position + i, dumps(reply)) for i, reply in enumerate(replies)]
+        self.connection.executemany("INSERT INTO replies (thread, position, reply) VALUES (?, ?, ?)", rows)
+        metrics.inc("storage_bytes_written_total", sum(len(reply.encode()) for _, _, reply in rows), backend="sqlite")
+
+    def _written(self) -> None:
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
@@ -0,0 +1,378 @@
+import asyncio
+import os
+import sys
+
+import aiofiles
+
+from logger import log_message, log_error
+from metrics import metrics
+from streaming_json import dumps, loads
+
+COMPACT_AFTER_BYTES = 256 * 1024
+# end of replies log that is read to find the last appended reply
+LOG_TAIL_BYTES = 64 * 1024
+STORAGE_BACKEND = "files"
+
+
+def unique_replies(replies: list) -> list:
+    """
+    :return: replies without repeated ones (by "no"), first copy is kept. Replies are appended before manifest is
+        flushed, so after a crash or a cancelled job the same replies can be appended once more
+    """
+    seen = set()
+    result = []
+    for reply in replies:
+        no = reply.get("no")
+        if no is not None:
+            if no in seen:
+                continue
+            seen.add(no)
+        result.append(reply)
+    return result
+
+
+def last_reply_no(replies: list) -> int:
+    """
+    :return: no of the last numbered reply, 0 if there is none
+    """
+    for reply in reversed(replies):
+        if reply.get("no"):
+            return reply["no"]
+    return 0
+
+
+def replies_after(replies: list, last_no: int) -> list:
+    """
+    :param last_no: no of the last stored reply
+    :return: replies that aren't stored yet, replies without "no" are kept. Backends drop the rest on append, because
+        after a crash before manifest flush the same replies are fetched and appended once more
+    """
+    return [reply for reply in replies if reply.get("no") is None or reply["no"] > last_no]
+
+
+class ThreadStorage:
+    """
+    Interface of thread storage backends.
+    Thread is saved once in the usual title/text/date/img_link/replies shape, replies that arrive later are appended
+    without rewriting stored ones. Use read() to get the current state of a thread. Backends may buffer writes until
+    flush(), manifest flushes storage before its own changes.
+    """
+
+    async def create(self, no: int, context: dict) -> None:
+        """
+        Saves whole thread, previous state of thread is dropped
+        """
+        raise NotImplementedError
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        """
+        :param replies: new replies, appended after already stored ones
+        :param compact: fold appended replies into thread right away (e.g. thread won't change anymore)
+        :return: replies that were written, already stored ones are dropped (see replies_after)
+        """
+        raise NotImplementedError
+
+    def read(self, no: int) -> dict:
+        """
+        :return: thread with all appended replies, KeyError if thread isn't stored
+        """
+        raise NotImplementedError
+
+    def read_header(self, no: int) -> dict:
+        """
+        :return: thread without replies, KeyError if thread isn't stored. Backends that keep it apart from replies
+            don't read replies
+        """
+        thread = self.read(no)
+        thread.pop("replies", None)
+        return thread
+
+    def compact(self, no: int) -> None:
+        """
+        Folds appended replies into thread
+        """
+        raise NotImplementedError
+
+    def compact_all(self) -> int:
+        """
+        :return: amount of compacted threads
+        """
+        raise NotImplementedError
+
+    def threads(self) -> list:
+        """
+        :return: numbers of stored threads
+        """
+        raise NotImplementedError
+
+    def modified(self, no: int) -> int:
+        """
+        :return: timestamp of the last write to thread
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class StorageWrapper(ThreadStorage):
+    """
+    Storage that passes every call to the wrapped one. Wrappers that act on saved posts (change feed, media queue,
+    search index) override create() and append() to write the wrapped storage first and then act, and flush() and
+    close() to include their own state
+    """
+
+    def __init__(self, storage: ThreadStorage):
+        self.storage = storage
+
+    async def create(self, no: int, context: dict) -> None:
+        await self.storage.create(no, context)
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        return await self.storage.append(no, replies, compact)
+
+    def read(self, no: int) -> dict:
+        return self.storage.read(no)
+
+    def read_header(self, no: int) -> dict:
+        return self.storage.read_header(no)
+
+    def compact(self, no: int) -> None:
+        self.storage.compact(no)
+
+    def compact_all(self) -> int:
+        return self.storage.compact_all()
+
+    def threads(self) -> list:
+        return self.storage.threads()
+
+    def modified(self, no: int) -> int:
+        return self.storage.modified(no)
+
+    def flush(self) -> None:
+        self.storage.flush()
+
+    def close(self) -> None:
+        self.storage.close()
+
+
+class FileStorage(ThreadStorage):
+    """
+    One file per thread.
+    {no}.json keeps thread in the usual title/text/date/img_link/replies shape, replies that arrive later are appended
+    as one JSON line each to {no}.replies.ndjson, so an update costs O(new replies) instead of rewriting the thread.
+    Compaction folds the log back into {no}.json.
+    """
+
+    def __init__(self, directory: str, compact_after: int = COMPACT_AFTER_BYTES):
+        self.directory = directory
+        self.compact_after = compact_after
+
+    def path(self, no: int) -> str:
+        return os.path.join(self.directory, f"{no}.json")
+
+    def log_path(self, no: int) -> str:
+        return os.path.join(self.directory, f"{no}.replies.ndjson")
+
+    async def create(self, no: int, context: dict) -> None:
+        """
+        Saves whole thread, previous state of thread is dropped
+        """
+        await self._write(no, context)
+        try:
+            os.remove(self.log_path(no))
+        except FileNotFoundError as _:
+            pass
+
+    async def append(self, no: int, replies: list, compact: bool = False) -> list:
+        """
+        :param replies: new replies, appended after already stored ones
+        :param compact: fold log into {no}.json right away (e.g. thread won't change anymore)
+        :return: replies that were written
+        """
+        log_path = self.log_path(no)
+        replies = replies_after(replies, self._last_logged(no))
+        records = "".join(dumps(reply) + "\n" for reply in replies)
+        async with aiofiles.open(log_path, mode='a', encoding="utf-8") as file:
+            await file.write(records)
+        metrics.inc("storage_bytes_written_total", len(records.encode()), backend="files")
+        if compact or os.path.getsize(log_path) >= self.compact_after:
+            self.compact(no)
+        return replies
+
+    def read(self, no: int) -> dict:
+        """
+        :return: thread with replies from log merged in
+        """
+        try:
+            with open(self.path(no), "r", encoding="utf-8") as file:
+                thread = loads(file.read())
+        except FileNotFoundError as _:
+            raise KeyError(no)
+        thread["replies"] = unique_replies(thread["replies"] + self._read_log(no))
+        for reply in thread["replies"]:
+            # replies appended by older versions kept image link under "img"
+            if "img" in reply:
+                reply["img_link"] = reply.pop("img")
+        return thread
+
+    def compact(self, no: int) -> None:
+        """
+        Folds replies log into {no}.json
+        """
+        if not os.path.exists(self.log_path(no)):
+            return
+        thread = self.read(no)
+        # written to temporary file first so readers never see half-written thread
+        tmp_path = self.path(no) + ".tmp"
+        data = dumps(thread)
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(data)
+        os.replace(tmp_path, self.path(no))
+        os.remove(self.log_path(no))
+        metrics.inc("storage_bytes_written_total", len(data.encode()), backend="files")
+
+    def compact_all(self) -> int:
+        """
+        :return: amount of compacted threads
+        """
+        compacted = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".replies.ndjson"):
+                self.compact(int(name.split(".")[0]))
+                compacted += 1
+        return compacted
+
+    def threads(self) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return [int(name[:-len(".json")]) for name in os.listdir(self.directory)
+                if name.endswith(".json") and name[:-len(".json")].isdigit()]
+
+    def modified(self, no: int) -> int:
+        if os.path.exists(self.log_path(no)):
+            return int(os.path.getmtime(self.log_path(no)))
+        return int(os.path.getmtime(self.path(no)))
+
+    def _last_logged(self, no: int) -> int:
+        """
+        :return: no of the last reply in replies log, 0 if log is missing or its tail can't be read
+        """
+        try:
+            with open(self.log_path(no), "rb") as file:
+                size = file.seek(0, os.SEEK_END)
+                file.seek(max(0, size - LOG_TAIL_BYTES))
+                tail = file.read()
+        except FileNotFoundError as _:
+            return 0
+        for line in reversed(tail.splitlines()):
+            try:
+                return loads(line).get("no") or 0
+            except ValueError as _:
+                continue
+        return 0
+
+    def _read_log(self, no: int) -> list:
+        replies = []
+        try:
+            with open(self.log_path(no), "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        replies.append(loads(line))
+                    except ValueError as _:
+                        # last line of log could be cut by crash during append
+                        log_error(f"Skipping broken reply record in {self.log_path(no)}")
+        except FileNotFoundError as _:
+            pass
+        return replies
+
+    async def _write(self, no: int, thread: dict) -> None:
+        tmp_path = self.path(no) + ".tmp"
+        data = dumps(thread)
+        async with aiofiles.open(tmp_path, mode='w', encoding="utf-8") as file:
+            await file.write(data)
+        os.replace(tmp_path, self.path(no))
+        metrics.inc("storage_bytes_written_total", len(data.encode()), backend="files")
+
+
+def open_storage(config: dict) -> ThreadStorage:
+    """
+    :param config: `storage_backend` is "files" (default), "sqlite", "segments" or "compressed", `storage_path` is
+        database file or directory of the last three, files are kept in `folder_path`. With `feed_path` saved posts are also
+        published to change feed, with `index_path` saved posts are added to search index, with `download_media` files
+        attached to saved posts are queued for media downloader
+    :return: storage backend
+    """
+    backend = config.get("storage_backend", STORAGE_BACKEND)
+    # imported here, because backends import this module
+    if backend == "files":
+        storage = FileStorage(config["folder_path"])
+    elif backend == "sqlite":
+        from sqlite_storage import SQLiteStorage, STORAGE_PATH
+        storage = SQLiteStorage(config.get("storage_path", STORAGE_PATH))
+    elif backend == "segments":
+        from segment_storage import SegmentStorage, SEGMENTS_PATH
+        storage = SegmentStorage(config.get("storage_path", SEGMENTS_PATH))
+    elif backend == "compressed":
+        from compressed_storage import CompressedStorage, COMPRESSED_PATH, COMPRESSION_LEVEL
+        storage = CompressedStorage(config.get("storage_path", COMPRESSED_PATH),
+                                    config.get("compression_level", COMPRESSION_LEVEL))
+    else:
+        raise ValueError(f"Unknown storage backend {backend}")
+    if config.get("feed_path"):
+        from change_feed import ChangeFeed, FeedStorage
+        storage = FeedStorage(storage, ChangeFeed.from_config(config))
+    if config.get("index_path"):
+        from search_index import IndexStorage, SearchIndex
+        storage = IndexStorage(storage, SearchIndex.from_config(config))
+    if config.get("download_media"):
+        from media import MediaQueue, MediaStorage
+        storage = MediaStorage(storage, MediaQueue.from_config(config))
+    return storage
+
+
+async def migrate(source: ThreadStorage, target: ThreadStorage) -> int:
+    """
+    Copies every thread of source storage into target storage, threads already in target are overwritten
+    :return: amount of copied threads
+    """
+    copied = 0
+    for no in source.threads():
+        try:
+            thread = source.read(no)
+        except (KeyError, ValueError) as _:
+            log_error(f"Unable to migrate thread {no}")
+            continue
+        await target.create(no, thread)
+        copied += 1
+        if copied % 10000 == 0:
+            log_message(f"STORAGE | MIGRATING | {copied} threads")
+    target.flush()
+    return copied
+
+
+if __name__ == "__main__":
+    # python storage.py compact <folder_path>
+    # python storage.py migrate <folder_path> <backend> [<storage_path>], storage_path is required by files
+    if len(sys.argv) == 3 and sys.argv[1] == "compact":
+        log_message(f"STORAGE | COMPACTED | {FileStorage(sys.argv[2]).compact_all()} threads")
+    elif len(sys.argv) == 4 and sys.argv[1] == "migrate" and sys.argv[3] == "files":
+        print("Migration to files needs <storage_path>, the folder where they are written")
+        sys.exit(1)
+    elif len(sys.argv) in (4, 5) and sys.argv[1] == "migrate":
+        target_config = {"storage_backend": sys.argv[3]}
+        if len(sys.argv) == 5:
+            target_config["storage_path"] = target_config["folder_path"] = sys.argv[4]
+        target_storage = open_storage(target_config)
+        try:
+            log_message(f"STORAGE | MIGRATED | {asyncio.run(migrate(FileStorage(sys.argv[2]), target_storage))} "
+                        f"threads to {sys.argv[3]}")
+        finally:
+            target_storage.close()
+    else:
+        print("Usage: python storage.py compact <folder_path>\n"
+              "       python storage.py migrate <folder_path> <files|sqlite|segments|compressed> [<storage_path>]")
+        sys.exit(1)
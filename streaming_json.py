@@ -0,0 +1,99 @@
+import codecs
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# size of chunks read off the socket while a JSON array is decoded
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+# characters that can continue a number decoded so far
+NUMBER_CHARS = "0123456789.eE+-"
+
+_decoder = json.JSONDecoder()
+
+
+def loads(data):
+    """
+    Decodes JSON with orjson if it is installed, with json module otherwise
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> str:
+    """
+    Encodes JSON with orjson if it is installed, with json module otherwise. orjson output is compact and keeps
+    non-ASCII characters, so files written with it have to be read as UTF-8
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+class ArrayDecoder:
+    """
+    Incremental decoder of a top-level JSON array (threads.json, catalog.json, archive.json).
+    Bytes are fed as they arrive off the socket and every element is returned as soon as it is complete, so work on
+    the first elements starts before the last ones are downloaded. Only the unfinished element is kept in memory.
+    """
+
+    def __init__(self):
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        # "start" before "[", "item" before element or "]", "separator" after element, "end" after "]"
+        self.state = "start"
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        :param chunk: next bytes of response body
+        :return: elements completed by the chunk
+        """
+        buffer = self.buffer + self.text_decoder.decode(chunk)
+        items = []
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if self.state == "start":
+                if char != "[":
+                    raise ValueError(f"Expected JSON array, got {char!r}")
+                self.state = "item"
+                pos += 1
+            elif self.state == "separator" and char == ",":
+                self.state = "item"
+                pos += 1
+            elif self.state in ("item", "separator") and char == "]":
+                self.state = "end"
+                pos += 1
+            elif self.state == "item":
+                try:
+                    item, end = _decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as _:
+                    # element isn't downloaded completely yet
+                    break
+                if isinstance(item, (int, float)) and (end == len(buffer) or buffer[end] in NUMBER_CHARS):
+                    # number ends only at "," "]" or whitespace, "1500." or "1e" may continue in the next chunk
+                    break
+                items.append(item)
+                self.state = "separator"
+                pos = end
+            else:
+                raise ValueError(f"Unexpected {char!r} in JSON array")
+        self.buffer = buffer[pos:]
+        return items
+
+    def close(self) -> None:
+        """
+        Checks that the whole array was received
+        """
+        self.feed(b"")
+        self.buffer += self.text_decoder.decode(b"", final=True)
+        if self.state != "end" or self.buffer.strip():
+            raise ValueError("JSON array is truncated")
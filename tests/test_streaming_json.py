@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming_json import ArrayDecoder  # noqa: E402
+
+
+def decode(chunks: list) -> list:
+    decoder = ArrayDecoder()
+    items = []
+    for chunk in chunks:
+        items.extend(decoder.feed(chunk))
+    decoder.close()
+    return items
+
+
+def test_whole_array():
+    assert decode([b'[{"no": 1}, 2, "three", true, null]']) == [{"no": 1}, 2, "three", True, None]
+
+
+def test_every_split():
+    data = b'[{"no": 100, "replies": [1, 2]}, 1500.25, -3e+2, 7]'
+    expected = [{"no": 100, "replies": [1, 2]}, 1500.25, -300.0, 7]
+    for i in range(1, len(data)):
+        assert decode([data[:i], data[i:]]) == expected, data[:i]
+
+
+def test_float_split_at_point():
+    decoder = ArrayDecoder()
+    assert decoder.feed(b'[{"a":1},1500.') == [{"a": 1}]
+    assert decoder.feed(b'25]') == [1500.25]
+    decoder.close()
+
+
+def test_exponent_split():
+    decoder = ArrayDecoder()
+    assert decoder.feed(b'[3e') == []
+    assert decoder.feed(b'+2') == []
+    assert decoder.feed(b',1') == [300.0]
+    assert decoder.feed(b']') == [1]
+    decoder.close()
+
+
+def test_utf8_split_inside_character():
+    data = '["привет"]'.encode()
+    assert decode([data[:3], data[3:]]) == ["привет"]
+
+
+def test_invalid_number():
+    with pytest.raises(ValueError):
+        decode([b'[1500x]'])
+
+
+def test_truncated():
+    with pytest.raises(ValueError):
+        decode([b'[1, 2'])
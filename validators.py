@@ -0,0 +1,69 @@
+import json
+import os
+
+from logger import log_error
+
+VALIDATORS_PATH = "validators.json"
+
+
+class ValidatorStore:
+    """
+    Per-URL Last-Modified / ETag values kept between runs.
+    Validators of a fresh response are held as pending until the caller commits them, so a resource that was
+    downloaded but not saved is requested in full on the next run instead of being answered with 304.
+    """
+
+    def __init__(self, path: str = VALIDATORS_PATH):
+        self.path = path
+        self.validators = {}
+        self.pending = {}
+
+    @classmethod
+    def load(cls, path: str = VALIDATORS_PATH) -> "ValidatorStore":
+        store = cls(path)
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as file:
+                    store.validators = json.load(file)
+            except (OSError, ValueError) as _:
+                log_error(f"Unable to read validators from {path}, starting without them")
+        return store
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.validators, file)
+        os.replace(tmp_path, self.path)
+
+    def headers(self, link: str, fallback_date: str = "") -> dict:
+        """
+        :param link: requested url
+        :param fallback_date: If-Modified-Since value used when nothing is stored for the url
+        :return: conditional request headers
+        """
+        stored = self.validators.get(link, {})
+        headers = {}
+        if stored.get("etag"):
+            headers["If-None-Match"] = stored["etag"]
+        if stored.get("last_modified") or fallback_date:
+            headers["If-Modified-Since"] = stored.get("last_modified") or fallback_date
+        return headers
+
+    def __contains__(self, link: str) -> bool:
+        return link in self.validators
+
+    def remember(self, link: str, response_headers) -> None:
+        validator = {
+            "last_modified": response_headers.get("Last-Modified", ""),
+            "etag": response_headers.get("ETag", "")
+        }
+        if validator["last_modified"] or validator["etag"]:
+            self.pending[link] = validator
+
+    def commit(self, link: str) -> None:
+        if link in self.pending:
+            self.validators[link] = self.pending.pop(link)
+
+    def forget(self, link: str) -> None:
+        self.pending.pop(link, None)
+        self.validators.pop(link, None)
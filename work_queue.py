@@ -0,0 +1,103 @@
+import asyncio
+import itertools
+import time
+
+from logger import log_error
+from metrics import metrics
+
+MAX_WORKERS = 32
+ITEM_TIMEOUT = 300
+RETRIES = 1
+# retried items go after every item that wasn't tried yet
+RETRY_PRIORITY = float("inf")
+
+
+class WorkQueue:
+    """
+    Priority queue of jobs shared by a pool of worker tasks.
+    There are no per-worker shares: a worker that finishes a job takes the next one from the common queue, so a huge
+    thread or a slow response holds one worker while the others keep draining the queue, and the pass takes about
+    total work / workers instead of the time of the slowest share. The pool has one worker per queued job up to
+    `max_workers` and shrinks as the queue drains. Jobs with lower priority go first, jobs of equal priority in order
+    of put(). A job that runs longer than `timeout` seconds is cancelled and retried up to `retries` times at the end
+    of the queue, a job that fails or keeps timing out is logged and counted, the pass goes on.
+    """
+
+    def __init__(self, name: str, max_workers: int = MAX_WORKERS, timeout: float = ITEM_TIMEOUT,
+                 retries: int = RETRIES):
+        """
+        :param name: label of queue in logs and metrics
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.queue = asyncio.PriorityQueue()
+        self.order = itertools.count()
+        self.workers = set()
+        self.running = False
+        self.done = 0
+        self.failed = 0
+
+    def put(self, job, priority: float = 0) -> None:
+        """
+        :param job: callable without arguments that returns awaitable, it is called again on retry
+        :param priority: lower goes first
+        """
+        self._put(job, priority, 0)
+
+    async def run(self) -> bool:
+        """
+        Runs workers until the queue is empty and every job is finished
+        :return: True if every job succeeded
+        """
+        self.running = True
+        try:
+            self._scale()
+            await self.queue.join()
+        finally:
+            self.running = False
+            for worker in self.workers:
+                worker.cancel()
+            await asyncio.gather(*self.workers, return_exceptions=True)
+        return not self.failed
+
+    def _put(self, job, priority: float, attempt: int) -> None:
+        self.queue.put_nowait((priority, next(self.order), attempt, job))
+        metrics.set("work_queue_depth", self.queue.qsize(), queue=self.name)
+        if self.running:
+            self._scale()
+
+    def _scale(self) -> None:
+        while len(self.workers) < min(self.max_workers, self.queue.qsize()):
+            worker = asyncio.create_task(self._work())
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+
+    async def _work(self) -> None:
+        while True:
+            try:
+                priority, _, attempt, job = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            metrics.set("work_queue_depth", self.queue.qsize(), queue=self.name)
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(job(), self.timeout)
+                self.done += 1
+                metrics.inc("work_items_total", queue=self.name, result="done")
+            except asyncio.TimeoutError as _:
+                if attempt < self.retries:
+                    metrics.inc("work_items_total", queue=self.name, result="retried")
+                    self._put(job, RETRY_PRIORITY, attempt + 1)
+                else:
+                    self.failed += 1
+                    metrics.inc("work_items_total", queue=self.name, result="timed_out")
+                    log_error(f"{self.name} | job timed out after {attempt + 1} attempts of {self.timeout}s")
+            except Exception as e:  # NOQA
+                self.failed += 1
+                metrics.inc("work_items_total", queue=self.name, result="failed")
+                log_error(f"{self.name} | {e!r}")
+            finally:
+                metrics.histogram("work_item_seconds", time.perf_counter() - started, queue=self.name)
+                self.queue.task_done()